@@ -0,0 +1,198 @@
+#!/bin/env python
+"""Benchmarks get-cbtzips-locally.py without touching the real cbttape.org.
+
+Starts a local FTP server (pyftpdlib) serving a synthetic pub/cbt, pub/updates and
+pub/updates/UPDATESTOC.txt, then runs the downloader against it twice:
+
+    full sync        : empty stage folder, everything gets downloaded
+    no-op refresh    : same stage folder again, nothing should get downloaded
+
+For both runs we report wall time, files/s, MB/s and the number of FTP connections
+the downloader opened. Same --seed gives the same tree, so numbers are comparable
+between versions of the downloader.
+
+Usage:
+    ./bench-cbtzips-download.py [-h] [--files FILES] [--median-kb MEDIAN_KB] [--sigma SIGMA]
+                                [--updated-pct UPDATED_PCT] [--bandwidth BANDWIDTH] [--seed SEED]
+                                [--keep] [downloader args ...]
+    Anything after the known options is passed on to get-cbtzips-locally.py, e.g. --pool 5 --adaptive
+
+Needs pyftpdlib (in requirements.txt, or pip install pyftpdlib), which is only used here.
+
+Author:
+    Wizard of z/OS
+
+Version:
+    1.0 : Inital Version
+"""
+import argparse
+import logging
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+
+try:
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler, ThrottledDTPHandler
+    from pyftpdlib.servers import FTPServer
+except ImportError:
+    print("This benchmark needs pyftpdlib for its local FTP server: pip install pyftpdlib")
+    sys.exit(8)
+
+
+parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter, description="""Benchmark get-cbtzips-locally.py against a local FTP stand-in for ftp.cbttape.org.
+Unknown options are passed on to get-cbtzips-locally.py""")
+
+parser.add_argument("--files", type=int,
+                    default=200,
+                    help=f"Number of synthetic CBT zips. Defaults to 200")
+
+parser.add_argument("--median-kb", type=int,
+                    default=200,
+                    help=f"Median zip size in KB (sizes are lognormal). Defaults to 200")
+
+parser.add_argument("--sigma", type=float,
+                    default=1.0,
+                    help=f"Sigma of the lognormal size distribution. Defaults to 1.0")
+
+parser.add_argument("--updated-pct", type=int,
+                    default=30,
+                    help=f"Percentage of files that are in pub/updates (flagged in the TOC). Defaults to 30")
+
+parser.add_argument("--bandwidth", type=int,
+                    default=0,
+                    help=f"Limit per data connection in KB/s (0 = unlimited). Defaults to 0")
+
+parser.add_argument("--seed", type=int,
+                    default=1040,
+                    help=f"Random seed for the synthetic tree. Defaults to 1040")
+
+parser.add_argument("--keep",
+                    action="store_true",
+                    help=f"Don't remove the temporary server tree and stage folder afterwards")
+
+args, downloader_args = parser.parse_known_args()
+
+here = os.path.dirname(os.path.abspath(__file__))
+downloader = os.path.join(here, 'get-cbtzips-locally.py')
+
+
+def build_tree(root, files, median_kb, sigma, updated_pct, seed):
+    """Create pub/cbt, pub/updates and UPDATESTOC.txt under root.
+
+    Every zip holds one stored (uncompressed) FILEnnn.XMI of random bytes, so it's a
+    valid zip file of about the chosen size.
+
+    Returns:
+        int: total bytes of all zips
+    """
+    rnd = random.Random(seed)
+    os.makedirs(f'{root}/pub/cbt')
+    os.makedirs(f'{root}/pub/updates')
+    toc = []
+    total = 0
+    for n in range(1, files + 1):
+        cbtnum = f'{n:03d}'
+        updated = rnd.randrange(100) < updated_pct
+        size = max(1, int(rnd.lognormvariate(math.log(median_kb * 1024), sigma)))
+        folder = 'updates' if updated else 'cbt'
+        zpath = f'{root}/pub/{folder}/CBT{cbtnum}.zip'
+        with zipfile.ZipFile(zpath, 'w', compression=zipfile.ZIP_STORED) as z:
+            z.writestr(f'FILE{cbtnum}.XMI', rnd.randbytes(size))
+        total += os.stat(zpath).st_size
+        comment = f'Synthetic tape {cbtnum} for benchmarking'
+        toc.append(f"//*+FILE{cbtnum}:  {comment:<60}*{'#' if updated else ' '}  DOC FILE\n")
+    with open(f'{root}/pub/updates/UPDATESTOC.txt', 'w') as f:
+        f.writelines(toc)
+    return total
+
+
+def start_server(root, bandwidth):
+    """Serve root read-only for anonymous on a free local port.
+
+    Returns:
+        tuple: (server, port, stats dict that counts connections, files and bytes sent)
+    """
+    stats = {'connections': 0, 'files': 0, 'bytes': 0}
+    authorizer = DummyAuthorizer()
+    authorizer.add_anonymous(root)
+
+    class CountingHandler(FTPHandler):
+        def on_connect(self):
+            stats['connections'] += 1
+
+        def on_file_sent(self, file):
+            if file.endswith('.zip'):
+                stats['files'] += 1
+                stats['bytes'] += os.stat(file).st_size
+
+    CountingHandler.authorizer = authorizer
+    CountingHandler.banner = 'cbt2git benchmark stand-in for ftp.cbttape.org'
+    if bandwidth:
+        dtp = ThrottledDTPHandler
+        dtp.write_limit = bandwidth * 1024
+        CountingHandler.dtp_handler = dtp
+    # pyftpdlib logs every command, we only want our table
+    logging.getLogger('pyftpdlib').addHandler(logging.NullHandler())
+    logging.getLogger('pyftpdlib').setLevel(logging.WARNING)
+    server = FTPServer(('127.0.0.1', 0), CountingHandler)
+    server.max_cons = 256
+    port = server.address[1]
+    t = threading.Thread(target=server.serve_forever, kwargs={'handle_exit': False}, daemon=True)
+    t.start()
+    return server, port, stats
+
+
+def run_downloader(workdir, port, extra):
+    """Run get-cbtzips-locally.py against the local server.
+
+    Returns:
+        float: wall time in seconds
+    """
+    cmd = [sys.executable, downloader,
+           '--server', f'127.0.0.1:{port}',
+           '--stage', f'{workdir}/stage',
+           '--catalog', f'{workdir}/.cbt.sqlite'] + extra
+    start = time.time()
+    res = subprocess.run(cmd, cwd=workdir, stdout=subprocess.DEVNULL)
+    wall = time.time() - start
+    if res.returncode != 0:
+        print(f"Downloader ended with rc={res.returncode}")
+    return wall
+
+
+workdir = tempfile.mkdtemp(prefix='cbtbench-')
+root = f'{workdir}/ftproot'
+print(f'Building {args.files} synthetic CBT zips in {root}')
+totalbytes = build_tree(root, args.files, args.median_kb, args.sigma, args.updated_pct, args.seed)
+print(f'{totalbytes/1024/1024:.1f} MB in total')
+
+server, port, stats = start_server(root, args.bandwidth)
+print(f'Local FTP server listening on 127.0.0.1:{port}')
+
+results = []
+for scenario in ['full sync', 'no-op refresh']:
+    before = dict(stats)
+    wall = run_downloader(workdir, port, downloader_args)
+    files = stats['files'] - before['files']
+    mb = (stats['bytes'] - before['bytes']) / 1024 / 1024
+    results.append((scenario, wall, files, files / wall, mb / wall, stats['connections'] - before['connections']))
+
+server.close_all()
+
+print('')
+print(f"{'scenario':<15} {'wall (s)':>9} {'files':>6} {'files/s':>8} {'MB/s':>8} {'connections':>12}")
+for scenario, wall, files, fps, mbps, conns in results:
+    print(f"{scenario:<15} {wall:>9.2f} {files:>6} {fps:>8.1f} {mbps:>8.2f} {conns:>12}")
+
+if args.keep:
+    print(f'Kept {workdir}')
+else:
+    shutil.rmtree(workdir)
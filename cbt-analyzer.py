@@ -7,9 +7,10 @@ import pandas as pd
 import xlsxwriter
 import os
 import zipfile, io 
-import xmi, json
+import json
 import time
 import datetime
+import hashlib
 
 import subprocess
 import glob
@@ -21,6 +22,17 @@ import shlex
 import argparse 
 import subprocess 
 
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from cbtxmi import XMIHandle
+from cbtmanifest import StageManifest
+from cbtcatalog import Catalog, CATALOG
+from cbttrace import Tracer
+
+# bump this whenever scan_tape() gives different rows, so cached results get thrown away
+ANALYZER_VERSION = 2
+
 # Errors found .... or not yet correctly parsing?
 # FILE003	NO XMI??	ERROR	ERROR	ERROR
 # FILE001	NO XMI??	ERROR	ERROR	ERROR
@@ -60,77 +72,173 @@ parser.add_argument("--only", type=int,
                     default=0,
                     help=f"""Only process this CBT Tape""")
 
-parser.add_argument("--pickle", type=str,
-                    default=f'.cbtscan.pkl',
-                    help=f"""Panda pickle file with parsed UPDATESTOC.txt information. Will be updated during this run. Defaults to .cbtscan.pkl""")
+parser.add_argument("--catalog", type=str,
+                    default=CATALOG,
+                    help=f"""Catalog (SQLite, see cbtcatalog.py) to write the member rows to, per tape as they come in.
+Shared with get-cbtzips-locally.py. Defaults to {CATALOG}""")
 
 parser.add_argument("--noparse",
                     action="store_true",
-                    help=f"Use existing pickle from earlier run. Don't parse stage again")
+                    help=f"Use the catalog from an earlier run. Don't parse stage again, just write the xlsx")
 
+parser.add_argument("--cache", type=str,
+                    default=f'.cbtscan.cache.json',
+                    help=f"""Rows per tape from earlier runs, keyed on the sha256 of the zip. Only tapes whose zip changed
+(or that are new) get analyzed again. Defaults to .cbtscan.cache.json""")
 
+parser.add_argument("--rescan",
+                    action="store_true",
+                    help=f"Ignore the cache and analyze every tape again (the cache is rewritten)")
 
-def getxmidata(xmifile):
-    xmijson = json.loads(xmi.open_file(xmifile,quiet=True).get_json())
-    try:
-        dsnam = xmijson['INMR02']['1']['INMDSNAM']
-    except:
+parser.add_argument("--trace", type=str,
+                    default='',
+                    help=f"Append timings per tape and stage to this JSONL file and print a summary at the end (see cbttrace.py)")
+
+parser.add_argument("--workers", type=int,
+                    default=1,
+                    help=f"""Analyze this many tapes in parallel (process pool, every tape is scanned in memory).
+Defaults to 1""")
+
+
+
+# what do we want to know about CBT-files? (one row per member, in this order, same as cbtcatalog.MEMBER_COLUMNS)
+COLUMNS = ['cbt',         # CBTnnnnn
+           'contains',    # What's in the .xmi --> SOME.DATASET.PS.OR.PO
+           'member',      # If content is PO, line per member, if content is PS -> empty
+           'extension',   # extenstion as detected by cpython (from xmilib)
+           'mimetype',
+           'subcontent']  # If this is another XMI.. this field is anohter 'contains' in the same cbt... (still makes sense?)
+
+
+def scan_dataset(cbt, handle, rows, prints, depth=0):
+    """Add the rows for the dataset in an XMI to rows and a fingerprint (sha256 and size
+    of the member data) per member to prints. Nested XMITs are parsed straight from the
+    member bytes and scanned the same way, to any depth.
+
+    Args:
+        cbt (string): FILEnnn
+        handle (XMIHandle): parsed XMI
+        rows (list): rows (lists with COLUMNS) to add to
+        prints (list): fingerprints (lists with cbtcatalog.FINGERPRINT_COLUMNS) to add to
+        depth (int): 0 for the XMI in the zip, 1 for an XMI in there, etc.
+    """
+    ds = handle.dataset
+    if not ds:
+        rows.append([cbt, 'ERROR', 'ERROR', 'ERROR', 'ERROR', 'ERROR'])
+        return
+    if not ds.is_pds:
+        rows.append([cbt, ds.dsnam, 'n.a.', 'n.a', 'n.a.', 'n.a'])
+        return
+    for m, member in ds.members.items():
+        xmit = member.mimetype == 'application/xmit'
+        if depth == 0:
+            subcontent = 'XMIT' if xmit else 'noXMIT'
+        else:
+            subcontent = 'XMIT' if xmit else 'n.a.'
+        rows.append([cbt, ds.dsnam, m, member.ext, member.mimetype, subcontent])
         try:
-            dsnam = xmijson['INMR02']['2']['INMDSNAM']
+            data = handle.member_data(m)
         except:
-            return False, False, False, False, False
-    dsorg = xmijson['INMR02']['1']['INMDSORG']
-    lrecl = xmijson['INMR02']['1']['INMLRECL']
-    if dsorg != "PS":
-        mbrs = [x for x in xmijson['file'][dsnam]['members']]
-    else:
-        mbrs = []
+            # RECFM=U members can come without data
+            data = None
+        # an alias is the same member under another name, not a copy
+        if data is not None and not member.alias:
+            prints.append([cbt, ds.dsnam, m, hashlib.sha256(data).hexdigest(), len(data)])
+        if xmit:
+            try:
+                nested = XMIHandle(data=data)
+            except:
+                rows.append([cbt, 'ERROR', 'ERROR', 'ERROR', 'ERROR', 'ERROR'])
+                continue
+            scan_dataset(cbt, nested, rows, prints, depth + 1)
+
+
+def scan_tape(z):
+    """Analyze one CBT zip. Everything happens in memory, so it's safe to run
+    a bunch of these at the same time (--workers)
+
+    Args:
+        z (string): path to CBTnnn.zip
+
+    Returns:
+        tuple: rows (lists with COLUMNS) and member fingerprints for this tape
+    """
+    rows = []
+    prints = []
+    cbtnum = z.split('/CBT')[-1].split('.')[0]
+    cbt = f"FILE{int(cbtnum):003d}"
+    lap = tracer.laps(cbtnum)
+    with zipfile.ZipFile(z, 'r') as zip_ref:
+        info =  zip_ref.infolist()
+        if len(info) > 1:
+            print(F"More than onze file in zip??? {z} => {info}, passing")
+            return rows, prints
+        xmidata = zip_ref.read(info[0])
+    lap('unzip', len(xmidata))
     try:
-        recfm  = xmijson['file'][dsnam]['COPYR1']['DS1RECFM']
+        # parse it once (from memory, nothing hits the disk), everything below works on this handle
+        handle = XMIHandle(data=xmidata)
     except:
-        recfm = 'n.a.'
-    members = {}
-    for m in mbrs:
-        if 'mimetype' in xmijson['file'][dsnam]['members'][m]:
-            mt = xmijson['file'][dsnam]['members'][m]['mimetype']
-        else:
-            mt = 'application/octet-stream' # force it :)
-        if 'datatype' in xmijson['file'][dsnam]['members'][m]:
-            dt = xmijson['file'][dsnam]['members'][m]['datatype']
-        else:
-            dt = 'binary'
-        if 'extension' in xmijson['file'][dsnam]['members'][m]:
-            ext = xmijson['file'][dsnam]['members'][m]['extension']
-        else:
-            ext = '.bin'
-        members[m] = {'mimetype': mt, 'datatype':dt,'ext':ext}
-    return dsnam, dsorg, lrecl, recfm, members
-
-
-def dexmi(xmifile, into="/tmp"):
-    dsnam, _, _, _, _ = getxmidata(xmifile)
-    xmi_obj = xmi.open_file(xmifile,quiet=True)
-    xmi_obj.set_output_folder('/tmp')
-    xmi_obj.set_quiet(True)
-    xmi_obj.extract_all()
-    return f"{into}/{dsnam}"
+        rows.append([cbt, 'NO XMI??', 'ERROR', 'ERROR', 'ERROR', 'ERROR'])
+        return rows, prints
+    lap('parse', len(xmidata))
+    scan_dataset(cbt, handle, rows, prints)
+    lap('scan')
+    return rows, prints
+
+
+def load_cache(path):
+    """Cached rows per zip: {'CBT001.zip': {'sha256': ..., 'rows': [...], 'fingerprints': [...]}}. Empty when there's
+    no cache yet or it was made by another ANALYZER_VERSION"""
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+    except FileNotFoundError:
+        return {}
+    if cache.get('version') != ANALYZER_VERSION:
+        print(f"Cache {path} is from another analyzer version, starting over")
+        return {}
+    return cache['tapes']
+
+
+def save_cache(path, tapes):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'version': ANALYZER_VERSION, 'tapes': tapes}, f)
+    os.replace(tmp, path)
+
+
+def progress(i, total, z):
+    pct = math.floor((i/total)*100)
+    done = math.floor((pct/100)*40)
+    todo = 40 - done
+    done = done * "✅"
+    todo = todo * "🟩"
+    print(f'{done}{todo} {z} ({pct}%)', end='\r', flush=True)
     
 
 args = parser.parse_args()
 
 stage    = args.stage
 only     = args.only
-pickle   = args.pickle
+workers  = args.workers
 
-import filecmp
-import shutil
+tracer = Tracer(args.trace, 'cbt-analyzer')
 
 toprocess= []
 
+catalog = Catalog(args.catalog)
+
+def tapenum(z):
+    return int(z.split('/CBT')[-1].split('.')[0])
+
 if not args.noparse:
     flist = os.listdir(stage)
 
     for i,filename in enumerate(flist):
+        # skip half-downloaded .part files and other non-zips
+        if not filename.endswith('.zip'):
+            continue
         # I've we selected a CBT, oly do that one
         if only > 0:
             cbtn = f"CBT{only:003d}.zip" 
@@ -144,99 +252,59 @@ if not args.noparse:
         else:
             print(f"Sorry, {src} not found. This really shouldn't happen.")
 
-    print(f"Need to process {len(toprocess)} CBT zips")
+    # CBT order, so the table comes out the same no matter how many workers we use
+    toprocess = sorted(toprocess, key=tapenum)
 
-    # what do we want to know about CBT-files?
-    cbtinfo = {}
-    cbtinfo['cbt']        = []         # CBTnnnnn
-    cbtinfo['contains']   = []         # What's in the .xmi --> SOME.DATASET.PS.OR.PO
-    cbtinfo['member']     = []         # If content is PO, line per member, if content is PS -> empty 
-    cbtinfo['extension']  = []         # extenstion as detected by cpython (from xmilib)
-    cbtinfo['mimetype']   = []
-    cbtinfo['subcontent'] = []         # If this is another XMI.. this field is anohter 'contains' in the same cbt... (still makes sense?)
+    # take what we can from the cache, the sha256s come from the stage manifest (no hashing if the downloader did that)
+    manifest = StageManifest(stage)
+    cache = {} if args.rescan else load_cache(args.cache)
+    hashes = {}
+    results = {}
+    toscan = []
+    incatalog = catalog.member_tapes()
+    for z in toprocess:
+        name = os.path.basename(z)
+        hashes[z] = manifest.sha256(name)
+        cached = cache.get(name)
+        if cached and cached['sha256'] == hashes[z]:
+            results[z] = cached['rows'], cached['fingerprints']
+            if tapenum(z) not in incatalog:
+                catalog.replace_members(tapenum(z), *results[z])
+        else:
+            toscan.append(z)
+    print(f"Need to process {len(toscan)} CBT zips ({len(results)} unchanged, from cache)")
+
+    if workers > 1:
+        # fork, so the workers get our parsed args and functions without re-running this script
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork')) as executor:
+            futures = {executor.submit(scan_tape, z): z for z in toscan}
+            for i, f in enumerate(as_completed(futures)):
+                z = futures[f]
+                progress(i, len(toscan), z)
+                results[z] = f.result()
+                catalog.replace_members(tapenum(z), *results[z])
+    else:
+        for i,z in enumerate(toscan):
+            progress(i, len(toscan), z)
+            results[z] = scan_tape(z)
+            catalog.replace_members(tapenum(z), *results[z])
+
+    # with --only we keep the rest of the cache, otherwise zips that left the stage folder drop out
+    tapes = dict(cache) if only > 0 else {}
+    for z in toprocess:
+        rows, prints = results[z]
+        tapes[os.path.basename(z)] = {'sha256': hashes[z], 'rows': rows, 'fingerprints': prints}
+    save_cache(args.cache, tapes)
+    if only == 0:
+        catalog.drop_members(incatalog - {tapenum(z) for z in toprocess})
 
-    for i,z in enumerate(toprocess):
-        try:
-            cbtnum = z.split('/CBT')[1].split('.')[0]
-        except:
-            print(f"eeek: {z}")
-        pct = math.floor((i/len(toprocess))*100) 
-        done = math.floor((pct/100)*40)
-        todo = 40 - done
-        done = done * "✅" 
-        todo = todo * "🟩"
-        print(f'{done}{todo} {z} ({pct}%)', end='\r', flush=True)      
-        with zipfile.ZipFile(z, 'r') as zip_ref:
-            info =  zip_ref.infolist()
-            if len(info) > 1:
-                print(F"More than onze file in zip??? {z} => {info}, passing")
-                continue
-            else:
-                xmifile = f"/tmp/{info[0].filename}"
-                zip_ref.extractall('/tmp')
-                try:
-                    contents = xmi.list_all(xmifile)
-                except:
-                    cbtinfo['cbt'].append(f"FILE{int(cbtnum):003d}")
-                    cbtinfo['contains'].append('NO XMI??')
-                    cbtinfo['member'].append('ERROR')
-                    cbtinfo['extension'].append('ERROR')
-                    cbtinfo['mimetype'].append('ERROR')
-                    cbtinfo['subcontent'].append('ERROR')
-                    continue
-                dsnam, dsorg, lrecl, recfm, members = getxmidata(xmifile)
-                if not dsnam:
-                    cbtinfo['cbt'].append(f"FILE{int(cbtnum):003d}")
-                    cbtinfo['contains'].append('ERROR')
-                    cbtinfo['member'].append('ERROR')
-                    cbtinfo['extension'].append('ERROR')
-                    cbtinfo['mimetype'].append('ERROR')
-                    cbtinfo['subcontent'].append('ERROR')
-                    continue
-                if dsorg != 'PS':
-                    for m in members:
-                        cbtinfo['cbt'].append(f"FILE{int(cbtnum):003d}")
-                        cbtinfo['contains'].append(dsnam)
-                        cbtinfo['member'].append(m)
-                        cbtinfo['extension'].append(members[m]['ext'])
-                        cbtinfo['mimetype'].append(members[m]['mimetype'])
-                        cbtinfo['subcontent'].append('XMIT' if members[m]['mimetype'] == 'application/xmit' else 'noXMIT')
-                        if members[m]['mimetype'] == 'application/xmit':
-                            xtract = dexmi(xmifile, into='/tmp')
-                            n_dsnam, n_dsorg, n_lrecl, m_recfm, n_members = getxmidata(xtract+"/"+m+members[m]['ext'])
-                            if n_dsorg != 'PS':
-                                for n_m in n_members:
-                                    cbtinfo['cbt'].append(f"FILE{int(cbtnum):003d}")
-                                    cbtinfo['contains'].append(n_dsnam)
-                                    cbtinfo['member'].append(n_m)
-                                    cbtinfo['extension'].append(n_members[n_m]['ext'])
-                                    cbtinfo['mimetype'].append(n_members[n_m]['mimetype'])
-                                    cbtinfo['subcontent'].append('n.a.')
-                            else:
-                                cbtinfo['cbt'].append(f"FILE{int(cbtnum):003d}")
-                                cbtinfo['contains'].append(n_dsnam)
-                                cbtinfo['member'].append('n.a.')
-                                cbtinfo['extension'].append('n.a')
-                                cbtinfo['mimetype'].append('n.a.')
-                                cbtinfo['subcontent'].append('n.a')
-                            # cleanup /tmp again :)
-                            os.system(f"rm -rf {xtract}")
-                else:
-                    cbtinfo['cbt'].append(f"FILE{int(cbtnum):003d}")
-                    cbtinfo['contains'].append(dsnam)
-                    cbtinfo['member'].append('n.a.')
-                    cbtinfo['extension'].append('n.a')
-                    cbtinfo['mimetype'].append('n.a.')
-                    cbtinfo['subcontent'].append('n.a')
-            # Cleanup tmp plox
-            os.system(f"rm -rf {xmifile}")
-    cbt = pd.DataFrame.from_dict(cbtinfo)
-    cbt.to_pickle(f'{args.pickle}')
-else:
-    cbt = pd.read_pickle(args.pickle)
 
+clusters, copies, saved = catalog.duplicate_summary()
+print(f"{clusters} members exist more than once ({copies} copies in total), {saved/1024/1024:.1f} MB could be saved")
 
 xlsx = 'cbt.xlsx'
-writer = pd.ExcelWriter(f'{xlsx}', engine='xlsxwriter')
-cbt.to_excel(writer, sheet_name='CBTTAPES', index=False)
-writer.close()
+with tracer.stage(None, 'xlsx'):
+    written = catalog.export_xlsx(xlsx, [('CBTTAPES', 'members'), ('DUPLICATES', 'duplicates')])
+print(f"{written['CBTTAPES']} rows and {written['DUPLICATES']} duplicate clusters written to {xlsx}")
+catalog.close()
+tracer.close()
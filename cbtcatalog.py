@@ -0,0 +1,197 @@
+"""The CBT catalog: one SQLite file shared by all the scripts, instead of pickles.
+
+get-cbtzips-locally.py fills the tapes table (one row per tape in UPDATESTOC.txt, with
+the remote size and modify time), cbt-analyzer.py the members table (one row per member,
+written per tape as soon as that tape is analyzed) and the fingerprints table (sha256 and
+size of the data of every member, nested ones included), which tells where the same member
+shows up on more than one tape. Anything that speaks SQL can read it:
+
+    sqlite3 .cbt.sqlite "select mimetype, count(*) from members group by mimetype"
+    sqlite3 .cbt.sqlite "select * from fingerprints where sha256 = '9f86d0...'"
+
+Loading into pandas gives typed columns, with the repeating text columns (mimetype,
+extension, ...) as categoricals, which keeps the member table small in memory.
+
+Author:
+    Wizard of z/OS
+
+Version:
+    1.0 : Inital Version
+    1.1 : Member fingerprints and duplicate clusters
+"""
+import sqlite3
+
+import pandas as pd
+import xlsxwriter
+
+
+CATALOG = '.cbt.sqlite'
+
+TAPE_COLUMNS = ['cbtnum', 'path', 'comment', 'updated', 'info', 'size', 'modify']
+MEMBER_COLUMNS = ['cbt', 'contains', 'member', 'extension', 'mimetype', 'subcontent']
+
+FINGERPRINT_COLUMNS = ['cbt', 'contains', 'member', 'sha256', 'size']
+DUPLICATE_COLUMNS = ['sha256', 'size', 'copies', 'tapes', 'saved', 'locations']
+
+# few distinct values, lots of rows
+CATEGORICAL = ['cbt', 'contains', 'extension', 'mimetype', 'subcontent']
+
+SCHEMA = """
+create table if not exists tapes (
+    cbtnum   text primary key,
+    path     text,
+    comment  text,
+    updated  integer,
+    info     text,
+    size     integer,
+    modify   text
+);
+create table if not exists members (
+    tape       integer,    -- cbtnum as a number, for ordering
+    cbt        text,
+    contains   text,
+    member     text,
+    extension  text,
+    mimetype   text,
+    subcontent text
+);
+create index if not exists members_tape on members (tape);
+create table if not exists fingerprints (
+    tape       integer,
+    cbt        text,
+    contains   text,
+    member     text,
+    sha256     text,
+    size       integer
+);
+create index if not exists fingerprints_tape on fingerprints (tape);
+create index if not exists fingerprints_sha256 on fingerprints (sha256);
+"""
+
+# members with the same content, biggest savings first (empty members don't count)
+DUPLICATES = """
+select sha256, size, count(*) as copies, count(distinct tape) as tapes, size * (count(*) - 1) as saved,
+       group_concat(cbt || ' ' || contains || '(' || member || ')', ', ') as locations
+from fingerprints
+where size > 0
+group by sha256, size
+having count(*) > 1
+order by saved desc, sha256
+"""
+
+# what export_xlsx() can write: name -> (columns, query)
+QUERIES = {
+    'members': (MEMBER_COLUMNS, f"select {','.join(MEMBER_COLUMNS)} from members order by tape, rowid"),
+    'tapes': (TAPE_COLUMNS, f"select {','.join(TAPE_COLUMNS)} from tapes order by rowid"),
+    'duplicates': (DUPLICATE_COLUMNS, DUPLICATES),
+}
+
+
+class Catalog:
+    """The catalog database.
+
+    Args:
+        path (string): SQLite file, created when it's not there
+    """
+
+    def __init__(self, path=CATALOG):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        # readers don't block the writer (and the other way around)
+        self.db.execute('pragma journal_mode=wal')
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def replace_tapes(self, rows):
+        """Replace the tapes table.
+
+        Args:
+            rows (list): dicts with TAPE_COLUMNS as keys
+        """
+        with self.db:
+            self.db.execute('delete from tapes')
+            self.db.executemany(f"insert into tapes values ({','.join('?' * len(TAPE_COLUMNS))})",
+                                [[row[c] for c in TAPE_COLUMNS] for row in rows])
+
+    def tapes(self):
+        """Tapes as a DataFrame (same columns the old .cbt.pkl had)."""
+        df = pd.read_sql_query('select * from tapes order by rowid', self.db)
+        df['updated'] = df['updated'].astype(bool)
+        return df
+
+    def replace_members(self, tape, rows, fingerprints=()):
+        """Replace the member rows (and member fingerprints) of one tape.
+
+        Args:
+            tape (int): cbtnum
+            rows (list): lists with MEMBER_COLUMNS
+            fingerprints (list): lists with FINGERPRINT_COLUMNS
+        """
+        with self.db:
+            self.db.execute('delete from members where tape = ?', (tape,))
+            self.db.executemany(f"insert into members values (?,{','.join('?' * len(MEMBER_COLUMNS))})",
+                                [[tape] + list(row) for row in rows])
+            self.db.execute('delete from fingerprints where tape = ?', (tape,))
+            self.db.executemany(f"insert into fingerprints values (?,{','.join('?' * len(FINGERPRINT_COLUMNS))})",
+                                [[tape] + list(row) for row in fingerprints])
+
+    def member_tapes(self):
+        """cbtnums that have member rows."""
+        return {t for (t,) in self.db.execute('select distinct tape from members')}
+
+    def drop_members(self, tapes):
+        """Remove the member rows and fingerprints of these tapes (cbtnums)."""
+        with self.db:
+            self.db.executemany('delete from members where tape = ?', [(t,) for t in tapes])
+            self.db.executemany('delete from fingerprints where tape = ?', [(t,) for t in tapes])
+
+    def members(self):
+        """Member rows as a DataFrame in CBT order, repeating columns as categoricals."""
+        df = pd.read_sql_query(f"select {','.join(MEMBER_COLUMNS)} from members order by tape, rowid", self.db)
+        for c in CATEGORICAL:
+            df[c] = df[c].astype('category')
+        return df
+
+    def where(self, sha256):
+        """Everywhere a member with this content lives: list of (tape, contains, member)."""
+        return self.db.execute('select tape, contains, member from fingerprints where sha256 = ? order by tape, rowid',
+                               (sha256,)).fetchall()
+
+    def duplicates(self):
+        """Duplicate clusters (DUPLICATE_COLUMNS) as a DataFrame, biggest savings first."""
+        return pd.read_sql_query(DUPLICATES, self.db)
+
+    def duplicate_summary(self):
+        """Returns:
+            tuple: (clusters, copies in those clusters, bytes saved if every cluster was stored once)
+        """
+        clusters, copies, saved = self.db.execute(
+            f"select count(*), coalesce(sum(copies), 0), coalesce(sum(saved), 0) from ({DUPLICATES})").fetchone()
+        return clusters, copies, saved
+
+    def export_xlsx(self, xlsx, sheets=[('CBTTAPES', 'members')]):
+        """Write QUERIES to sheets of an xlsx, row by row from the database, so memory use
+        doesn't depend on the number of rows (xlsxwriter constant_memory mode).
+
+        Args:
+            xlsx (string): file to write
+            sheets (list): (sheet name, QUERIES key) tuples
+
+        Returns:
+            dict: rows written per sheet
+        """
+        workbook = xlsxwriter.Workbook(xlsx, {'constant_memory': True})
+        bold = workbook.add_format({'bold': True})
+        written = {}
+        for sheet, query in sheets:
+            columns, sql = QUERIES[query]
+            worksheet = workbook.add_worksheet(sheet)
+            worksheet.write_row(0, 0, columns, bold)
+            n = 0
+            for n, row in enumerate(self.db.execute(sql), start=1):
+                worksheet.write_row(n, 0, row)
+            written[sheet] = n
+        workbook.close()
+        return written
@@ -0,0 +1,445 @@
+"""FTP helpers shared by the cbt2git scripts.
+
+ftp.cbttape.org doesn't like lots of new connections, so instead of a fresh
+FTP() + login() per file we keep a bounded pool of logged-in sessions that
+worker threads check out and hand back.
+
+Usage:
+    pool = FTPPool('ftp.cbttape.org', size=15)
+    remote = pool.run(lambda ftp: remote_state(ftp, ['pub/cbt', 'pub/updates']))
+    pool.run(lambda ftp: download(ftp, 'pub/cbt/CBT002.zip', 'stage/CBT002.zip', size=12345))
+    pool.close()
+
+Author:
+    Wizard of z/OS
+
+Version:
+    1.0 : Inital Version (connection pool)
+    1.1 : Bulk directory listings (MLSD, LIST as fallback)
+    1.2 : Resumable downloads into a .part file, renamed into place when complete
+    1.3 : sha256 of downloads is calculated while streaming
+    1.4 : AdaptiveLimiter, AIMD controlled number of simultaneous downloads
+    1.5 : Zips are checked (central directory and CRCs) before they're renamed into place
+"""
+from ftplib import FTP
+import ftplib
+import hashlib
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+import datetime
+import zipfile
+from contextlib import contextmanager
+
+
+class FTPPool:
+    """A bounded pool of long-lived, logged-in FTP sessions.
+
+    At most `size` sessions are checked out at the same time. Idle sessions
+    are reused (most recently used first), sessions idle for longer than
+    `keepalive` seconds get a NOOP before they're handed out and are replaced
+    when that fails.
+
+    Args:
+        host (string): ftp server to connect to
+        port (int, optional): ftp port. Defaults to 21.
+        size (int, optional): Max simultaneous sessions. Defaults to 15.
+        keepalive (int, optional): Seconds a session may idle before it's checked. Defaults to 30.
+        timeout (int, optional): Socket timeout for the sessions. Defaults to 60.
+    """
+
+    def __init__(self, host, port=21, size=15, keepalive=30, timeout=60):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.keepalive = keepalive
+        self.timeout = timeout
+        self.opened = 0  # connections opened during the lifetime of the pool
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        ftp = FTP(timeout=self.timeout)
+        ftp.connect(self.host, self.port)
+        ftp.login()  # per default anonymous :)
+        with self._lock:
+            self.opened += 1
+        return ftp
+
+    def _discard(self, ftp):
+        try:
+            ftp.close()
+        except Exception:
+            pass
+
+    def acquire(self):
+        """Check out a session, waiting for a free slot if all are in use.
+
+        Returns:
+            FTP: a logged-in session
+        """
+        self._slots.acquire()
+        try:
+            while True:
+                try:
+                    ftp, lastused = self._idle.get_nowait()
+                except queue.Empty:
+                    return self._connect()
+                if time.time() - lastused < self.keepalive:
+                    return ftp
+                try:
+                    ftp.voidcmd('NOOP')
+                    return ftp
+                except ftplib.all_errors:
+                    # stale session, server hung up on us
+                    self._discard(ftp)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, ftp, broken=False):
+        """Hand a session back to the pool.
+
+        Args:
+            ftp (FTP): session from acquire()
+            broken (bool, optional): Session is unusable, close it instead of reusing. Defaults to False.
+        """
+        if broken:
+            self._discard(ftp)
+        else:
+            self._idle.put((ftp, time.time()))
+        self._slots.release()
+
+    @contextmanager
+    def session(self):
+        """Context manager around acquire()/release(). Sessions that raised
+        an FTP or socket error are closed instead of returned to the pool."""
+        ftp = self.acquire()
+        try:
+            yield ftp
+        except ftplib.all_errors:
+            self.release(ftp, broken=True)
+            raise
+        except BaseException:
+            self.release(ftp)
+            raise
+        else:
+            self.release(ftp)
+
+    def run(self, func, retries=1):
+        """Run func(ftp) on a pooled session, reconnecting and retrying when
+        the session turns out to be stale.
+
+        Args:
+            func (callable): called with a logged-in FTP session
+            retries (int, optional): Extra attempts on connection errors. Defaults to 1.
+
+        Returns:
+            whatever func returns
+        """
+        for attempt in range(retries + 1):
+            try:
+                with self.session() as ftp:
+                    return func(ftp)
+            except (EOFError, OSError, ftplib.error_temp):
+                if attempt == retries:
+                    raise
+
+    def close(self):
+        """Log out and close all idle sessions."""
+        while True:
+            try:
+                ftp, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                ftp.quit()
+            except ftplib.all_errors:
+                self._discard(ftp)
+
+
+MONTHS = {m: i for i, m in enumerate(['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+                                      'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'], start=1)}
+
+
+def parse_list_line(line, now=None):
+    """Parse one line of a unix style LIST response.
+
+    Args:
+        line (string): e.g. '-rw-r--r--   1 ftp  ftp   123456 Mar 12  2023 CBT001.zip'
+        now (datetime, optional): Used to find the year for recent files. Defaults to utcnow.
+
+    Returns:
+        tuple: (name, {'type', 'size', 'modify'}) or None if this is no file entry
+    """
+    parts = line.split(None, 8)
+    if len(parts) < 9 or parts[0][0] not in '-d':
+        return None
+    perms, _, _, _, size, month, day, yeartime, name = parts
+    if month not in MONTHS:
+        return None
+    now = now or datetime.datetime.utcnow()
+    if ':' in yeartime:
+        hour, minute = yeartime.split(':')
+        stamp = datetime.datetime(now.year, MONTHS[month], int(day), int(hour), int(minute))
+        if stamp > now + datetime.timedelta(days=1):
+            # no year means 'within the last 6 months', so this was last year
+            stamp = stamp.replace(year=now.year - 1)
+    else:
+        stamp = datetime.datetime(int(yeartime), MONTHS[month], int(day))
+    facts = {'type': 'dir' if perms[0] == 'd' else 'file',
+             'size': int(size),
+             'modify': stamp.strftime('%Y%m%d%H%M%S')}
+    return name, facts
+
+
+def list_remote(ftp, folder):
+    """List a remote folder with one MLSD, falling back to parsing LIST
+    when the server doesn't support MLSD.
+
+    Args:
+        ftp (FTP): logged-in session
+        folder (string): remote folder, e.g. 'pub/cbt'
+
+    Returns:
+        dict: filename -> {'size': int, 'modify': 'YYYYMMDDHHMMSS'} for all files in folder
+    """
+    files = {}
+    try:
+        for name, facts in ftp.mlsd(folder, facts=['type', 'size', 'modify']):
+            if facts.get('type', 'file') != 'file':
+                continue
+            files[name] = {'size': int(facts.get('size', -1)),
+                           'modify': facts.get('modify', '')[:14]}
+        return files
+    except ftplib.error_perm:
+        files = {}  # 500/502, no MLSD here
+    lines = []
+    ftp.retrlines(f'LIST {folder}', lines.append)
+    for line in lines:
+        parsed = parse_list_line(line)
+        if parsed and parsed[1]['type'] == 'file':
+            name, facts = parsed
+            files[name.split('/')[-1]] = {'size': facts['size'], 'modify': facts['modify']}
+    return files
+
+
+def remote_state(ftp, folders):
+    """Size and modify time of every file in folders, keyed on remote path.
+
+    Args:
+        ftp (FTP): logged-in session
+        folders (list): remote folders to list
+
+    Returns:
+        dict: 'folder/filename' -> {'size': int, 'modify': 'YYYYMMDDHHMMSS'}
+    """
+    state = {}
+    for folder in folders:
+        for name, facts in list_remote(ftp, folder).items():
+            state[f'{folder}/{name}'] = facts
+    return state
+
+
+class IncompleteDownload(Exception):
+    """Transfer finished but the local file doesn't have the remote size."""
+
+
+class CorruptDownload(Exception):
+    """Downloaded zip has a broken central directory or bad CRCs. It's in quarantine now."""
+
+
+def verify_zip(path):
+    """Check the central directory and the CRC of every member of a zip.
+
+    Returns:
+        string: None if the zip is fine, otherwise what's wrong with it
+    """
+    try:
+        with zipfile.ZipFile(path) as z:
+            bad = z.testzip()
+    except (zipfile.BadZipFile, zipfile.LargeZipFile, EOFError, OSError, NotImplementedError) as e:
+        # BadZipFile covers CBT990 style 'File is not a zip file' and CBT432 style 'Bad CRC-32'
+        return str(e)
+    if bad is not None:
+        return f'bad CRC for {bad}'
+    return None
+
+
+def quarantine(path):
+    """Move a broken file into the .quarantine folder next to it.
+
+    Returns:
+        string: where it went
+    """
+    folder = os.path.join(os.path.dirname(path), '.quarantine')
+    os.makedirs(folder, exist_ok=True)
+    # retries can break within the same second, mkstemp gives every one of them its own name
+    fd, target = tempfile.mkstemp(prefix=f"{os.path.basename(path)}.{time.strftime('%Y%m%d%H%M%S')}.", dir=folder)
+    os.close(fd)
+    shutil.move(path, target)
+    return target
+
+
+def download(ftp, remotefile, storeat, size=-1, verify=True):
+    """Download remotefile to storeat without ever leaving a truncated storeat.
+
+    Data goes to storeat + '.part' which is renamed into place once it's
+    complete. When a .part from an earlier (interrupted) attempt is there
+    and smaller than the remote file we resume it with REST.
+    The sha256 is calculated in the same pass as the bytes arrive (for a
+    resumed file the part that's already there is hashed from disk first).
+    Zips are verified (see verify_zip) before the rename, broken ones go to
+    quarantine so they never show up in the stage folder.
+
+    Args:
+        ftp (FTP): logged-in session
+        remotefile (string): remote filename
+        storeat (string): local filename
+        size (int, optional): Remote size if known (from the listing). Defaults to -1.
+        verify (bool, optional): Verify .zip files before renaming them into place. Defaults to True.
+
+    Raises:
+        IncompleteDownload: when the .part doesn't end up with the remote size
+        CorruptDownload: when the zip is broken (and quarantined)
+
+    Returns:
+        tuple: (bytes transferred in this call, sha256 hexdigest of the complete file)
+    """
+    part = storeat + '.part'
+    try:
+        offset = os.stat(part).st_size
+    except FileNotFoundError:
+        offset = 0
+    if size < 0 or offset >= size:
+        # nothing to resume from (or it's bogus), start over
+        offset = 0
+    sha = hashlib.sha256()
+    if offset:
+        with open(part, 'rb') as fp:
+            for block in iter(lambda: fp.read(1024 * 1024), b''):
+                sha.update(block)
+    ftp.voidcmd('TYPE I')  # REST offsets only make sense in binary
+    transferred = 0
+    with open(part, 'ab' if offset else 'wb') as fp:
+        def write(block):
+            nonlocal transferred
+            fp.write(block)
+            sha.update(block)
+            transferred += len(block)
+        ftp.retrbinary(f"RETR {remotefile}", write, rest=offset or None)
+    got = os.stat(part).st_size
+    if size >= 0 and got != size:
+        raise IncompleteDownload(f"{remotefile}: got {got} bytes, expected {size}")
+    if verify and storeat.endswith('.zip'):
+        problem = verify_zip(part)
+        if problem:
+            target = quarantine(part)
+            raise CorruptDownload(f"{remotefile}: {problem}, quarantined as {target}")
+    os.replace(part, storeat)
+    return transferred, sha.hexdigest()
+
+
+def is_overload(e):
+    """True if an exception looks like the server telling us to back off
+    (421, refused or reset connections, timeouts)."""
+    if isinstance(e, ftplib.error_temp):
+        return str(e).startswith('421')
+    return isinstance(e, (ConnectionRefusedError, ConnectionResetError, TimeoutError, EOFError))
+
+
+class AdaptiveLimiter:
+    """Limits the number of simultaneous downloads and tunes that limit (AIMD).
+
+    Every `limit` finished downloads form a window. When the throughput of a
+    window is better than that of the previous one the limit goes up by one
+    (additive increase), when the server pushes back (see is_overload) it's
+    halved (multiplicative decrease).
+
+    Args:
+        start (int): limit to start with
+        minimum (int, optional): never go below this. Defaults to 1.
+        maximum (int, optional): never go above this (the pool size). Defaults to 15.
+    """
+
+    def __init__(self, start, minimum=1, maximum=15):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = max(minimum, min(start, maximum))
+        self.active = 0
+        self.overloads = 0
+        self._cond = threading.Condition()
+        self._lastrate = 0.0
+        self._newwindow()
+
+    def _newwindow(self):
+        self._windowstart = time.time()
+        self._windowbytes = 0
+        self._windowdone = 0
+
+    def acquire(self):
+        """Wait for a download slot."""
+        with self._cond:
+            while self.active >= self.limit:
+                self._cond.wait()
+            self.active += 1
+
+    def success(self, nbytes):
+        """Release a slot after a download of nbytes finished."""
+        with self._cond:
+            self.active -= 1
+            try:
+                self._windowbytes += nbytes
+                self._windowdone += 1
+                if self._windowdone >= self.limit:
+                    rate = self._windowbytes / max(time.time() - self._windowstart, 0.001)
+                    if rate > self._lastrate * 1.05 and self.limit < self.maximum:
+                        self.limit += 1
+                    self._lastrate = rate
+                    self._newwindow()
+            finally:
+                # whatever happened, the slot is free, so nobody waits for it forever
+                self._cond.notify_all()
+
+    def failure(self, e):
+        """Release a slot after a failed download.
+
+        Returns:
+            bool: True if the failure was an overload (and the limit was lowered)
+        """
+        with self._cond:
+            self.active -= 1
+            try:
+                overload = is_overload(e)
+                if overload:
+                    self.overloads += 1
+                    self.limit = max(self.minimum, self.limit // 2)
+                    self._lastrate = 0.0
+                    self._newwindow()
+            finally:
+                self._cond.notify_all()
+            return overload
+
+    def run(self, func, retries=3, backoff=5):
+        """Run func() in a slot, retrying with exponential backoff on overloads.
+
+        Args:
+            func (callable): does the download, returns bytes transferred
+            retries (int, optional): Extra attempts after an overload. Defaults to 3.
+            backoff (int, optional): Seconds to wait after the first overload, doubles every time. Defaults to 5.
+        """
+        for attempt in range(retries + 1):
+            self.acquire()
+            try:
+                nbytes = func()
+            except Exception as e:
+                if not self.failure(e) or attempt == retries:
+                    raise
+                time.sleep(backoff * 2 ** attempt)
+            else:
+                self.success(nbytes)
+                return nbytes
@@ -0,0 +1,142 @@
+"""Commit a converted repo with git fast-import instead of git add + git commit.
+
+git add . hashes every file of the working tree and writes an index for it, and
+the commit after that walks the index again. For the initial build of all the tapes
+that's a lot of scanning for repos that get written once. fast_import_commit()
+streams the files of the working tree straight into the object database (as a pack)
+and points the branch at a new commit with exactly that tree:
+
+    err = fast_import_commit('.cbtrepos/CBT123', 'CBT123 : Initial commit')
+
+The blobs are the bytes on disk, same as git add stores them (we have no text/eol
+attributes that would change them), so the commits are the same as the git add ones.
+
+When the caller knows what changed since the last commit, only those paths go into the
+stream and everything else stays as it was in the parent commit:
+
+    err = fast_import_commit('.cbtrepos/CBT123', 'Updates', paths=['FILE123/MYMAC', '.zigi/FILE123'])
+
+Author:
+    Wizard of z/OS
+
+Version:
+    1.0 : Inital Version
+    1.1 : paths= to commit only what changed
+"""
+import os
+import subprocess
+
+
+def _git(repopath, *args):
+    return subprocess.run(['git', *args], cwd=repopath, capture_output=True)
+
+
+def _mode(path):
+    if os.path.islink(path):
+        return '120000'
+    if os.access(path, os.X_OK):
+        return '100755'
+    return '100644'
+
+
+def _tree(repopath, top=''):
+    """Files to commit: (path in repo, mode, path on disk), .git left out.
+
+    Args:
+        repopath (string): the repo
+        top (string): only this folder (path in repo), the whole working tree when empty
+    """
+    files = []
+    start = os.path.join(repopath, top) if top else repopath
+    skip = len(repopath.rstrip(os.sep)) + 1
+    for root, dirs, names in os.walk(start):
+        if root == repopath:
+            dirs[:] = [d for d in dirs if d != '.git']
+        prefix = root[skip:].replace(os.sep, '/') + '/' if len(root) > skip else ''
+        for name in names:
+            path = os.path.join(root, name)
+            files.append((prefix + name, _mode(path), path))
+    return sorted(files)
+
+
+def _quote(path):
+    # fast-import wants C-style quoting for paths with odd characters (and ones starting with ")
+    if any(c in path for c in '"\\\n') or path.startswith('"'):
+        return '"' + path.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+    return path
+
+
+def fast_import_commit(repopath, message, branch='main', paths=None):
+    """Commit everything in repopath on branch, through one git fast-import stream.
+    The repo gets initialized (with branch checked out) when there's no .git yet, an
+    existing branch gets the new commit on top. Files that are gone from the working
+    tree are gone from the commit too.
+
+    Args:
+        repopath (string): folder with the converted tape
+        message (string): commit message
+        branch (string): branch to commit on
+        paths (list, optional): only these paths in the repo (files or folders) changed since
+            the last commit, the ones that are gone get deleted. Ignored on a new branch.
+
+    Returns:
+        string: what git complained about when it failed, None when it worked
+    """
+    if not os.path.isdir(os.path.join(repopath, '.git')):
+        for cmd in [['init', '--quiet'], ['symbolic-ref', 'HEAD', f'refs/heads/{branch}']]:
+            res = _git(repopath, *cmd)
+            if res.returncode != 0:
+                return f"git {cmd[0]} failed ({res.returncode}): {res.stderr.decode(errors='replace').strip()}"
+
+    # whatever git commit would use (config, GIT_COMMITTER_* env) plus the time
+    res = _git(repopath, 'var', 'GIT_COMMITTER_IDENT')
+    if res.returncode != 0:
+        return f"git var failed ({res.returncode}): {res.stderr.decode(errors='replace').strip()}"
+    committer = res.stdout.decode().strip()
+    parent = _git(repopath, 'rev-parse', '--verify', '--quiet', f'refs/heads/{branch}').returncode == 0
+
+    proc = subprocess.Popen(['git', 'fast-import', '--quiet', '--done'], cwd=repopath, bufsize=1024 * 1024,
+                            stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    try:
+        out = proc.stdin
+        msg = message.encode()
+        out.write(f"commit refs/heads/{branch}\ncommitter {committer}\ndata {len(msg)}\n".encode() + msg + b"\n")
+        if parent:
+            # restarting on an existing branch, fast-import doesn't look at refs by itself
+            out.write(f"from refs/heads/{branch}^0\n".encode())
+        if parent and paths is not None:
+            # just what changed, a folder gets replaced as a whole
+            files = []
+            for p in paths:
+                out.write(f"D {_quote(p)}\n".encode())
+                full = os.path.join(repopath, p)
+                if os.path.isdir(full) and not os.path.islink(full):
+                    files += _tree(repopath, p)
+                elif os.path.lexists(full):
+                    files.append((p, _mode(full), full))
+        else:
+            # the working tree is the whole truth
+            out.write(b"deleteall\n")
+            files = _tree(repopath)
+        for inrepo, mode, path in files:
+            if mode == '120000':
+                data = os.readlink(path).encode()
+            else:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            out.write(f"M {mode} inline {_quote(inrepo)}\ndata {len(data)}\n".encode() + data + b"\n")
+        out.write(b"\ndone\n")
+        out.close()
+    except BrokenPipeError:
+        pass
+    err = proc.stderr.read().decode(errors='replace').strip()
+    if proc.wait() != 0:
+        return f"git fast-import failed ({proc.returncode}): {err}"
+
+    # index to match the new commit (no hashing, just the tree), so git status makes sense.
+    # --reset (-m that doesn't mind the working tree being ahead of the index) keeps what
+    # the index knows about files that didn't change.
+    res = _git(repopath, 'read-tree', '--reset', f'refs/heads/{branch}')
+    if res.returncode != 0:
+        return f"git read-tree failed ({res.returncode}): {res.stderr.decode(errors='replace').strip()}"
+    return None
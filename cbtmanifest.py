@@ -0,0 +1,121 @@
+"""Stage manifest: what's in the stage folder and where it came from.
+
+The downloader records remote path, size, remote modify time and sha256 for
+every zip it puts in the stage folder. That way freshness is decided on
+(size, modify) against the remote listing, and process-local-cbtzips.py can
+see which tapes changed by comparing hashes instead of copying and
+byte-comparing every zip.
+
+Next to those, every entry has the local mtime (in ns) of the file it describes. When
+the file on disk doesn't match that (size or mtime), the sha256 isn't trusted and
+the file is hashed again, so a zip that was replaced without the manifest being
+saved (an interrupted download run) never passes for the old one.
+
+The manifest lives in the stage folder as .manifest.json:
+
+    {
+        "CBT001.zip": {"path": "pub/updates/CBT001.zip", "size": 12345,
+                       "modify": "20230312101500", "sha256": "9f86d0...",
+                       "mtime": 1678616100123456789},
+        ...
+    }
+
+Author:
+    Wizard of z/OS
+
+Version:
+    1.0 : Inital Version
+    1.1 : Local mtime per entry, stale sha256s are hashed again. Unknown zips are verified before they're adopted
+"""
+import hashlib
+import json
+import os
+import threading
+
+from cbtftp import verify_zip, quarantine
+
+
+MANIFEST = '.manifest.json'
+
+
+def sha256_file(path):
+    """sha256 hexdigest of a local file, read in 1MB blocks."""
+    sha = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(1024 * 1024), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class StageManifest:
+    """The .manifest.json of a stage folder. Safe to update from download threads.
+
+    Args:
+        stage (string): stage folder
+    """
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.path = os.path.join(stage, MANIFEST)
+        self._lock = threading.Lock()
+        try:
+            with open(self.path) as fp:
+                self.entries = json.load(fp)
+        except FileNotFoundError:
+            self.entries = {}
+
+    def get(self, name):
+        """Manifest entry for a stage file (e.g. 'CBT001.zip') or None."""
+        return self.entries.get(name)
+
+    def record(self, name, path, size, modify, sha256):
+        """Add or replace the entry for a stage file (its local mtime is taken from disk)."""
+        mtime = os.stat(os.path.join(self.stage, name)).st_mtime_ns
+        with self._lock:
+            self.entries[name] = {'path': path, 'size': size, 'modify': modify, 'sha256': sha256, 'mtime': mtime}
+
+    def _matches(self, entry, st):
+        # the file on disk is still the one the entry was recorded for
+        return entry.get('mtime') == st.st_mtime_ns and entry.get('size') == st.st_size
+
+    def is_fresh(self, name, size, modify):
+        """True if the staged file matches the remote size and modify time.
+
+        A stage file without manifest entry (from before we had one) that has the
+        right size is verified (zips), hashed once and adopted, so we don't download
+        everything again. A broken zip goes to quarantine and gets downloaded again.
+        Same for a file that isn't the one its entry was recorded for (other mtime).
+        """
+        local = os.path.join(self.stage, name)
+        try:
+            st = os.stat(local)
+        except FileNotFoundError:
+            return False
+        if st.st_size != size:
+            return False
+        entry = self.get(name)
+        if entry is not None and (entry['size'] != size or entry['modify'] != modify):
+            return False
+        if entry is None or not self._matches(entry, st):
+            # not the file we downloaded (or from before we recorded mtimes)
+            if name.endswith('.zip') and verify_zip(local):
+                quarantine(local)
+                return False
+            self.record(name, entry and entry['path'], size, modify, sha256_file(local))
+        return True
+
+    def sha256(self, name):
+        """sha256 of a stage file, from the manifest if it's still about the file on disk, hashed otherwise."""
+        local = os.path.join(self.stage, name)
+        entry = self.get(name)
+        if entry and entry.get('sha256') and self._matches(entry, os.stat(local)):
+            return entry['sha256']
+        return sha256_file(local)
+
+    def save(self):
+        """Write the manifest (to a temp file first, so it's never half written)."""
+        with self._lock:
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as fp:
+                json.dump(self.entries, fp, indent=1, sort_keys=True)
+            os.replace(tmp, self.path)
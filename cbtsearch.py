@@ -0,0 +1,138 @@
+"""Full-text search over the converted members in .cbtrepos.
+
+process-local-cbtzips.py indexes every text member of a tape right after converting
+it, replacing whatever that tape had in the index before. The index is an SQLite FTS5
+table with the trigram tokenizer, so any (case insensitive) substring of 3 characters
+or more is found through the index instead of grepping a million files:
+
+    index = SearchIndex('.cbtsearch.sqlite')
+    index.replace_tape(123, [('FILE123', 'MYMAC', 'text of the member'), ...])
+    for tape, pds, member, lineno, line in index.search('IEFBR14'):
+        ...
+
+search-cbtrepos.py is the command line for it.
+
+Author:
+    Wizard of z/OS
+
+Version:
+    1.0 : Inital Version
+"""
+import os
+import sqlite3
+
+
+SEARCHINDEX = '.cbtsearch.sqlite'
+
+SCHEMA = """
+create table if not exists docs (
+    id      integer primary key,
+    tape    integer,
+    pds     text,
+    member  text
+);
+create index if not exists docs_tape on docs (tape);
+create virtual table if not exists fts using fts5(text, tokenize='trigram');
+"""
+
+# folders in a repo that don't hold members
+NOT_PDS = ['.git', '.zigi', 'docs']
+
+
+def repo_members(repopath):
+    """Text members of a converted repo: (pds, member, text) for every file in a
+    PDS folder that's not binary.
+
+    Args:
+        repopath (string): .cbtrepos/CBTnnn
+    """
+    for pds in sorted(os.listdir(repopath)):
+        folder = os.path.join(repopath, pds)
+        if pds in NOT_PDS or not os.path.isdir(folder):
+            continue
+        for member in sorted(os.listdir(folder)):
+            path = os.path.join(folder, member)
+            if not os.path.isfile(path):
+                continue
+            with open(path, 'rb') as f:
+                data = f.read()
+            if b'\0' in data:
+                continue
+            yield pds, member, data.decode('utf-8', errors='replace')
+
+
+class SearchIndex:
+    """The search index database.
+
+    Args:
+        path (string): SQLite file, created when it's not there
+    """
+
+    def __init__(self, path=SEARCHINDEX):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute('pragma journal_mode=wal')
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def replace_tape(self, tape, members):
+        """Replace everything indexed for a tape.
+
+        Args:
+            tape (int): cbtnum
+            members (iterable): (pds, member, text) tuples, e.g. from repo_members()
+
+        Returns:
+            int: members indexed
+        """
+        n = 0
+        with self.db:
+            self.db.execute('delete from fts where rowid in (select id from docs where tape = ?)', (tape,))
+            self.db.execute('delete from docs where tape = ?', (tape,))
+            for pds, member, text in members:
+                docid = self.db.execute('insert into docs (tape, pds, member) values (?, ?, ?)',
+                                        (tape, pds, member)).lastrowid
+                self.db.execute('insert into fts (rowid, text) values (?, ?)', (docid, text))
+                n += 1
+        return n
+
+    def drop_tape(self, tape):
+        """Remove a tape from the index."""
+        self.replace_tape(tape, [])
+
+    def search(self, text, tape=None, limit=100):
+        """Case insensitive substring search.
+
+        Args:
+            text (string): what to look for, 3 characters or more use the index
+            tape (int, optional): only look in this tape
+            limit (int): stop after this many line hits
+
+        Returns:
+            list: (tape, pds, member, lineno, line) per matching line
+        """
+        if len(text) >= 3:
+            # one quoted phrase, so FTS5 syntax in the search text has no meaning
+            where = 'docs.id in (select rowid from fts where fts match ?)'
+            params = ['"' + text.replace('"', '""') + '"']
+        else:
+            # too short for trigrams, do it the slow way
+            where = 'instr(lower(fts.text), lower(?)) > 0'
+            params = [text]
+        if tape is not None:
+            where += ' and docs.tape = ?'
+            params.append(tape)
+        sql = f"""select docs.tape, docs.pds, docs.member, fts.text
+                  from docs join fts on fts.rowid = docs.id
+                  where {where} order by docs.tape, docs.pds, docs.member"""
+        hits = []
+        needle = text.lower()
+        for dtape, pds, member, content in self.db.execute(sql, params):
+            for lineno, line in enumerate(content.splitlines(), start=1):
+                if needle in line.lower():
+                    hits.append((dtape, pds, member, lineno, line))
+                    if len(hits) >= limit:
+                        return hits
+        return hits
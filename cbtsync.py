@@ -0,0 +1,290 @@
+"""Everything process-local-cbtzips.py does on GitHub, in a queue next to the conversion.
+
+Creating repos, pushing and updating descriptions used to happen right after converting
+a tape, with fixed sleeps in between (10s after a create, 30s every tenth tape, twice the
+grace time after every push and 600s when a create failed). The conversion sat and waited
+for all of that. Now the converter only queues the work:
+
+    sync = GitHubSync(github, me, tracer, pushers=4)
+    sync.start()
+    sync.publish('123', 'CBT123', '.cbtrepos/CBT123', 'Some description')
+    sync.describe('124', 'CBT124', 'Other description')
+    fulllog += sync.close()      # waits until everything is done
+
+and one thread works through the queue of API calls, as fast as GitHub lets it:
+
+    - before every API call, when the primary rate limit (X-RateLimit-Remaining) is almost
+      used up, wait until X-RateLimit-Reset
+    - mutating calls (create, edit) at least a second apart, as GitHub asks
+    - on a rate limit answer (403/429, primary or secondary) wait for Retry-After, or the
+      reset time, or back off exponentially, and try again
+    - server errors are retried with an exponential backoff too
+
+Pushes don't count against the API rate limits, so once a repo is there its push goes to
+a pool of `pushers` threads, and the API thread goes on with the next job. A push that
+fails (a just created repo is not always ready) is retried with a backoff, and what still
+fails after that gets a summary in the log. All pushes share one SSH connection to GitHub
+(ControlMaster, unless GIT_SSH_COMMAND or GIT_SSH is set already), so the SSH handshake
+is paid once instead of once per repo.
+
+Which repos exist comes from one paginated listing of the owner's repos when the thread
+starts, kept up to date as repos get created. So there's no get_repo() per tape to find
+out, a create hands us the ssh_url, and a description that's already right isn't sent.
+
+Author:
+    Wizard of z/OS
+
+Version:
+    1.0 : Inital Version
+    1.1 : One cached listing of the owner's repos instead of get_repo() per tape
+    1.2 : Pushes in parallel (pushers), over one shared SSH connection
+"""
+import datetime
+import os
+import queue
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from github import GithubException
+
+
+class GitHubSync:
+    """Queue and worker thread for the GitHub side of the conversion.
+
+    Args:
+        github (Github): logged on PyGithub object (for the rate limits and get_repo)
+        owner: PyGithub user or organization that gets the repos (create_repo, login)
+        tracer (Tracer, optional): gets 'github' and 'ratelimit' stages per tape
+        attempts (int): tries per job before it goes into the log as an ALERT
+        reserve (int): keep this many API calls of the primary rate limit for the rest
+        spacing (float): seconds between mutating calls
+        pushers (int): git pushes running at the same time
+    """
+
+    def __init__(self, github, owner, tracer=None, attempts=6, reserve=20, spacing=1.0, pushers=4):
+        self.github = github
+        self.owner = owner
+        self.tracer = tracer
+        self.attempts = attempts
+        self.reserve = reserve
+        self.spacing = spacing
+        self.queue = queue.Queue()
+        self.log = []       # lines for the full log, handed back by close()
+        self.done = 0
+        self.failed = 0
+        self.waited = 0     # seconds spent waiting for GitHub
+        self.last_mutation = 0
+        self.repos = None   # name -> Repository, from _load_repos()
+        self.thread = threading.Thread(target=self._run, name='github-sync', daemon=True)
+        self.pushers = pushers
+        self.pool = None
+        self.pushes = []        # futures of the pushes
+        self.push_failures = [] # (reponame, what git said)
+        self.lock = threading.Lock()
+        self.sshdir = None
+        self.env = None
+
+    def start(self):
+        """Start working on the queue. With a fork process pool, call this after the pool
+        has started its workers, forking a process with running threads can deadlock it."""
+        self.env = dict(os.environ)
+        if 'GIT_SSH_COMMAND' not in self.env and 'GIT_SSH' not in self.env:
+            # one SSH connection for all pushes, the pushes are sessions on it
+            self.sshdir = tempfile.mkdtemp(prefix='cbt2git-ssh-')
+            self.env['GIT_SSH_COMMAND'] = (f"ssh -o ControlMaster=auto -o ControlPath={self.sshdir}/%C "
+                                           f"-o ControlPersist=60")
+        self.pool = ThreadPoolExecutor(max_workers=self.pushers, thread_name_prefix='github-push')
+        self.thread.start()
+
+    def publish(self, cbtnum, reponame, repopath, description):
+        """Queue: create the repo on GitHub when it's not there yet, then push main."""
+        self.queue.put(('publish', cbtnum, reponame, repopath, description))
+
+    def describe(self, cbtnum, reponame, description):
+        """Queue: update the description of a repo."""
+        self.queue.put(('describe', cbtnum, reponame, None, description))
+
+    def pending(self):
+        """Jobs waiting for the API thread plus pushes not done yet."""
+        return self.queue.qsize() + sum(1 for f in self.pushes if not f.done())
+
+    def close(self):
+        """Wait until everything queued is done, pushes included.
+
+        Returns:
+            list: log lines (the ALERTs and a summary of failed pushes included) for the full log
+        """
+        self.queue.put(None)
+        if self.thread.is_alive():
+            self.thread.join()
+        if self.pool:
+            self.pool.shutdown(wait=True)
+        if self.push_failures:
+            self._log(f"** ALERT ** {len(self.push_failures)} pushes failed: " +
+                      ', '.join(f"{reponame} ({err})" for reponame, err in sorted(self.push_failures)))
+        if self.sshdir:
+            # stop the shared SSH connection (if there is one) instead of letting it linger
+            for host in self._ssh_hosts():
+                subprocess.run(['ssh', '-o', f'ControlPath={self.sshdir}/%C', '-O', 'exit', host], capture_output=True)
+            shutil.rmtree(self.sshdir, ignore_errors=True)
+        return self.log
+
+    def _ssh_hosts(self):
+        hosts = set()
+        for repo in (self.repos or {}).values():
+            url = getattr(repo, 'ssh_url', '') or ''
+            if '@' in url and ':' in url:
+                hosts.add(url.split(':')[0])
+        return hosts
+
+    def _log(self, line, cbtnum=None):
+        alert = f" ** ALERT CBT{cbtnum} **" if cbtnum else ''
+        self.log.append(f"{datetime.datetime.now()} -{alert} {line}" + "\n")
+
+    def _load_repos(self):
+        repos = self._retry(None, lambda: list(self.owner.get_repos()))
+        self.repos = {r.name: r for r in repos}
+        self._log(f"Found {len(self.repos)} repos on GitHub for {self.owner.login}")
+
+    def _run(self):
+        try:
+            self._load_repos()
+        except Exception as e:
+            # nothing we can do without it, the jobs will fail one by one
+            self._log(f"** ALERT ** Could not list the GitHub repos of {self.owner.login}: {e}")
+            print(f"** Could not list the GitHub repos of {self.owner.login}: {e}")
+            self.repos = {}
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            what, cbtnum, reponame, repopath, description = job
+            start = time.perf_counter()
+            waited = self.waited
+            try:
+                if what == 'publish':
+                    self._publish(cbtnum, reponame, repopath, description)
+                else:
+                    self._describe(cbtnum, reponame, description)
+                    with self.lock:
+                        self.done += 1
+            except Exception as e:
+                with self.lock:
+                    self.failed += 1
+                self._log(f"GitHub {what} of {reponame} gave up: {e}", cbtnum)
+                print(f"** GitHub {what} of {reponame} failed: {e}")
+            if self.tracer:
+                # the waiting itself is in the 'ratelimit' stage
+                self.tracer.record(cbtnum, 'github', time.perf_counter() - start - (self.waited - waited))
+
+    def _publish(self, cbtnum, reponame, repopath, description):
+        repo = self.repos.get(reponame)
+        if repo is None:
+            try:
+                repo = self._retry(cbtnum, lambda: self.owner.create_repo(reponame, private=False, description=description),
+                                   mutating=True)
+                self._log(f"Created GitHub repo {reponame}")
+            except GithubException as e:
+                if e.status != 422:
+                    raise
+                # created by someone else since we listed them
+                repo = self._retry(cbtnum, lambda: self.github.get_repo(f'{self.owner.login}/{reponame}'))
+            self.repos[reponame] = repo
+        # also for repos that were there, the local one may be freshly rebuilt
+        remote = subprocess.run(['git', 'remote', 'add', 'origin', repo.ssh_url], cwd=repopath,
+                                capture_output=True, text=True)
+        if remote.returncode != 0:
+            subprocess.run(['git', 'remote', 'set-url', 'origin', repo.ssh_url], cwd=repopath,
+                           capture_output=True, text=True)
+        self.pushes.append(self.pool.submit(self._push, cbtnum, reponame, repopath))
+
+    def _describe(self, cbtnum, reponame, description):
+        repo = self.repos.get(reponame)
+        if repo is None:
+            raise LookupError(f"there's no {reponame} on GitHub")
+        if repo.description == description:
+            return
+        self._retry(cbtnum, lambda: repo.edit(description=description), mutating=True)
+        self._log(f"Updated description of {reponame}")
+
+    def _push(self, cbtnum, reponame, repopath):
+        """git push in one of the pusher threads, retried with a backoff."""
+        start = time.perf_counter()
+        for attempt in range(1, self.attempts + 1):
+            res = subprocess.run(['git', 'push', '-u', 'origin', 'main', '--quiet'], cwd=repopath,
+                                 capture_output=True, text=True, env=self.env)
+            if res.returncode == 0:
+                self._log(f"Pushed {reponame} to GitHub")
+                with self.lock:
+                    self.done += 1
+                break
+            # on one line, the full log gets sorted line by line
+            said = ' / '.join(line.strip() for line in res.stderr.splitlines() if line.strip())
+            err = f"git push failed ({res.returncode}): {said}"
+            if attempt == self.attempts:
+                self._log(f"GitHub publish of {reponame} gave up: {err}", cbtnum)
+                print(f"** GitHub publish of {reponame} failed: {err}")
+                with self.lock:
+                    self.failed += 1
+                    self.push_failures.append((reponame, err))
+                break
+            wait = 5 * min(2 ** (attempt - 1), 64)
+            self._log(f"{err}, retry {attempt} in {wait}s", cbtnum)
+            time.sleep(wait)
+        if self.tracer:
+            self.tracer.record(cbtnum, 'push', time.perf_counter() - start)
+
+    def _retry(self, cbtnum, call, mutating=False):
+        """call() until it works, waiting as long as GitHub tells us to in between.
+        Errors that waiting doesn't fix (like a 404) go straight to the caller."""
+        for attempt in range(1, self.attempts + 1):
+            self._wait_for_budget(cbtnum)
+            if mutating:
+                self._sleep(cbtnum, self.last_mutation + self.spacing - time.time())
+                self.last_mutation = time.time()
+            try:
+                return call()
+            except GithubException as e:
+                wait = self._backoff(e, attempt)
+                if wait is None or attempt == self.attempts:
+                    raise
+                self._log(f"GitHub said {e}, retry {attempt} in {wait:.0f}s", cbtnum)
+                self._sleep(cbtnum, wait)
+
+    def _backoff(self, e, attempt):
+        """Seconds to wait before trying again, None when trying again won't help."""
+        exponential = min(2 ** (attempt - 1), 64)
+        headers = {k.lower(): v for k, v in (getattr(e, 'headers', None) or {}).items()}
+        if e.status in (403, 429):
+            if 'retry-after' in headers:
+                return int(headers['retry-after']) + 1
+            if headers.get('x-ratelimit-remaining') == '0' and 'x-ratelimit-reset' in headers:
+                return max(int(headers['x-ratelimit-reset']) - time.time(), 0) + 1
+            if e.status == 429 or 'rate limit' in str(e.data).lower():
+                # secondary rate limit without a hint, GitHub says wait at least a minute
+                return 60 * exponential
+            return None
+        if e.status >= 500:
+            return 5 * exponential
+        return None
+
+    def _wait_for_budget(self, cbtnum):
+        # the numbers of the last response we got, no API call needed for that
+        remaining, limit = self.github.rate_limiting
+        if remaining < self.reserve:
+            wait = self.github.rate_limiting_resettime - time.time() + 1
+            if wait > 0:
+                print(f"GitHub rate limit at {remaining}/{limit}, waiting {wait:.0f}s for the reset")
+            self._sleep(cbtnum, wait)
+
+    def _sleep(self, cbtnum, seconds):
+        if seconds <= 0:
+            return
+        time.sleep(seconds)
+        self.waited += seconds
+        if self.tracer:
+            self.tracer.record(cbtnum, 'ratelimit', seconds)
@@ -0,0 +1,148 @@
+"""UPDATESTOC.txt parsing and change sets between two catalogs.
+
+Lines in UPDATESTOC.txt look like
+
+    //*+FILE001:  CBT DOC - Final File 001 for Version 504           *#  DOC FILE
+
+where '#' marks a file that's in pub/updates. parse_toc_line() turns one of those
+into a catalog row, changeset() tells what changed compared to the previous catalog:
+
+    {
+        "added":           ["1041"],         # new tapes
+        "removed":         [],               # gone from the TOC
+        "flag_changed":    ["123"],          # update flag (and so the path) changed
+        "comment_changed": ["456"],          # new description
+        "downloaded":      ["123", "1041"]   # filled in by the downloader
+    }
+
+The change set file is a hand over from get-cbtzips-locally.py to process-local-cbtzips.py.
+The downloader merges what it found into the change set that's still there (merge_changesets()),
+so running it twice before the processor doesn't lose the tapes of the first run. The processor
+writes back what it didn't get done (consume_changeset()) and removes the file when that's nothing.
+
+Author:
+    Wizard of z/OS
+
+Version:
+    1.0 : Inital Version
+    1.1 : merge_changesets() and consume_changeset(), change sets pile up until they're processed
+"""
+import json
+import os
+import re
+
+
+TOC_COLUMNS = ['cbtnum', 'path', 'comment', 'updated', 'info']
+
+# same as parse.parse('//*+{}:  {}*{}  {}\n', line) but compiled once
+TOC_LINE = re.compile(r'//\*\+(.+?):  (.+?)\*(.+?)  (.+?)\n?$')
+FILE_NUM = re.compile(r'FILE', re.IGNORECASE)
+
+
+def parse_toc_line(line):
+    """Parse one UPDATESTOC.txt line.
+
+    Args:
+        line (string): line, with or without the newline
+
+    Returns:
+        dict: catalog row with TOC_COLUMNS as keys, or None for lines that aren't a tape
+    """
+    # check for weird last line...
+    if len(line.rstrip('\n')) < 4:
+        return None
+    match = TOC_LINE.match(line)
+    if not match:
+        return None
+    file, comment, updated, info = match.groups()
+    cbtnum = FILE_NUM.split(file, maxsplit=1)[-1].strip()
+    updated = updated == '#'
+    return {'cbtnum': cbtnum,
+            'path': f"pub/{'updates' if updated else 'cbt'}/CBT{cbtnum}.zip",
+            'comment': comment.strip(),
+            'updated': updated,
+            'info': info}
+
+
+def changeset(previous, current):
+    """Compare two catalogs.
+
+    Args:
+        previous (list): rows (dicts) of the previous catalog, empty if there was none
+        current (list): rows (dicts) of the new catalog
+
+    Returns:
+        dict: lists of cbtnums for 'added', 'removed', 'flag_changed' and 'comment_changed'
+    """
+    prev = {row['cbtnum']: row for row in previous}
+    cur = {row['cbtnum']: row for row in current}
+    common = [n for n in cur if n in prev]
+    return {'added': [n for n in cur if n not in prev],
+            'removed': [n for n in prev if n not in cur],
+            'flag_changed': [n for n in common if bool(prev[n]['updated']) != bool(cur[n]['updated'])],
+            'comment_changed': [n for n in common if prev[n]['comment'] != cur[n]['comment']]}
+
+
+def save_changeset(changes, path):
+    """Write a change set as json (via a temp file, so readers never see half of it)."""
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(changes, f, indent=1)
+    os.replace(tmp, path)
+
+
+def load_changeset(path):
+    """Read a change set written by save_changeset()."""
+    with open(path) as f:
+        return json.load(f)
+
+
+def changed_tapes(changes):
+    """cbtnums whose zip needs (re)processing: added, moved to/from pub/updates or downloaded."""
+    return set(changes['added']) | set(changes['flag_changed']) | set(changes.get('downloaded', []))
+
+
+def _union(*lists, without=()):
+    # keeps the order, first one wins
+    return [n for n in dict.fromkeys(n for l in lists for n in l) if n not in without]
+
+
+def merge_changesets(older, newer):
+    """Change set with everything of an older (not yet processed) one and a newer one.
+
+    A tape added in one and removed in the other is in neither list, tapes that are gone
+    in the newer one are dropped from the rest.
+
+    Args:
+        older (dict): change set still waiting for the processor
+        newer (dict): change set of this run
+
+    Returns:
+        dict: the merged change set
+    """
+    gone = set(newer['removed'])
+    back = set(newer['added'])
+    return {'added': _union(older['added'], newer['added'], without=gone),
+            'removed': _union(older['removed'], newer['removed'], without=back | set(older['added'])),
+            'flag_changed': _union(older['flag_changed'], newer['flag_changed'], without=gone),
+            'comment_changed': _union(older['comment_changed'], newer['comment_changed'], without=gone),
+            'downloaded': _union(older.get('downloaded', []), newer.get('downloaded', []), without=gone)}
+
+
+def consume_changeset(changes, pending, described):
+    """What's left of a change set after the processor went through it.
+
+    Args:
+        changes (dict): the change set that was processed
+        pending (set): cbtnums that still need processing (failed, or not looked at)
+        described (bool): the changed comments went to GitHub
+
+    Returns:
+        dict: the change set to keep, None when there's nothing left in it
+    """
+    left = {'added': [n for n in changes['added'] if n in pending],
+            'removed': [],
+            'flag_changed': [n for n in changes['flag_changed'] if n in pending],
+            'comment_changed': [] if described else list(changes['comment_changed']),
+            'downloaded': [n for n in changes.get('downloaded', []) if n in pending]}
+    return left if any(left.values()) else None
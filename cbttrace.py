@@ -0,0 +1,139 @@
+"""Opt-in timing of where the scripts spend their time (--trace in all three of them).
+
+Every finished stage of a tape becomes one line in a JSONL trace:
+
+    {"run": "20231014-101500-4711", "script": "process-local-cbtzips", "pid": 4711, "tape": "123",
+     "stage": "git", "seconds": 1.234, "bytes": 0, "peak_rss_kb": 81234, "ts": 1697271300.5}
+
+Lines are written with one os.write() on an O_APPEND file, so threads and forked worker
+processes can all write to the same trace. At the end summary() reads this run back and
+prints the slowest tapes and the totals per stage (and writes that to {trace}.summary.txt).
+
+Without a trace file a Tracer does nothing, so the scripts can call it unconditionally:
+
+    tracer = Tracer(args.trace, 'cbt-analyzer')
+    with tracer.stage('123', 'parse', nbytes=len(data)):
+        ...
+    lap = tracer.laps('123')     # for long stretches of code that are hard to indent
+    ...
+    lap('readme')                # time since the previous lap (or since laps())
+
+Author:
+    Wizard of z/OS
+
+Version:
+    1.0 : Inital Version
+"""
+import contextlib
+import datetime
+import json
+import os
+import resource
+import threading
+import time
+
+
+def peak_rss_kb():
+    """Peak resident set size in KB of this process and its (waited for) children."""
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children)
+
+
+class Tracer:
+    """Writes stage timings to a JSONL trace.
+
+    Args:
+        path (string): JSONL file to append to, None or '' to trace nothing
+        script (string): name of the script, goes into every line
+    """
+
+    def __init__(self, path, script):
+        self.path = path
+        self.script = script
+        self.run = f"{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644) if path else None
+
+    @property
+    def enabled(self):
+        return self.fd is not None
+
+    def record(self, tape, stage, seconds, nbytes=0):
+        """Write one line to the trace."""
+        if not self.enabled:
+            return
+        line = json.dumps({'run': self.run, 'script': self.script, 'pid': os.getpid(), 'tape': tape,
+                           'stage': stage, 'seconds': round(seconds, 6), 'bytes': nbytes,
+                           'peak_rss_kb': peak_rss_kb(), 'ts': time.time()})
+        os.write(self.fd, (line + '\n').encode())
+
+    @contextlib.contextmanager
+    def stage(self, tape, stage, nbytes=0):
+        """Time the with-block as one stage of a tape (also when it raises)."""
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(tape, stage, time.perf_counter() - start, nbytes)
+
+    def laps(self, tape):
+        """Returns a lap(stage, nbytes=0) function that records the time since the previous lap."""
+        last = [time.perf_counter()]
+
+        def lap(stage, nbytes=0):
+            now = time.perf_counter()
+            self.record(tape, stage, now - last[0], nbytes)
+            last[0] = now
+        return lap
+
+    def summary(self, top=10):
+        """Print (and write to {trace}.summary.txt) the slowest tapes and the totals per stage of this run."""
+        if not self.enabled:
+            return
+        events = []
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    e = json.loads(line)
+                except ValueError:
+                    continue
+                if e.get('run') == self.run:
+                    events.append(e)
+        tapes = {}
+        stages = {}
+        peak = 0
+        for e in events:
+            peak = max(peak, e['peak_rss_kb'])
+            if e['tape'] is not None:
+                tapes[e['tape']] = tapes.get(e['tape'], 0) + e['seconds']
+            s = stages.setdefault(e['stage'], {'count': 0, 'seconds': 0, 'max': 0, 'bytes': 0})
+            s['count'] += 1
+            s['seconds'] += e['seconds']
+            s['max'] = max(s['max'], e['seconds'])
+            s['bytes'] += e['bytes']
+
+        lines = [f"Trace {self.path}, run {self.run} ({self.script}), peak RSS {peak/1024:.1f} MB", '']
+        lines.append(f"{'slowest tapes':<15} {'seconds':>10}")
+        for tape, seconds in sorted(tapes.items(), key=lambda t: -t[1])[:top]:
+            lines.append(f"{'CBT' + str(tape):<15} {seconds:>10.3f}")
+        lines.append('')
+        lines.append(f"{'stage':<15} {'count':>7} {'total (s)':>10} {'mean (s)':>9} {'max (s)':>9} {'MB':>9} {'MB/s':>8}")
+        for stage, s in sorted(stages.items(), key=lambda t: -t[1]['seconds']):
+            mb = s['bytes'] / 1024 / 1024
+            mbps = f"{mb / s['seconds']:>8.2f}" if s['bytes'] and s['seconds'] else f"{'':>8}"
+            lines.append(f"{stage:<15} {s['count']:>7} {s['seconds']:>10.3f} {s['seconds']/s['count']:>9.3f} "
+                         f"{s['max']:>9.3f} {mb:>9.2f} {mbps}")
+        print('\n'.join(lines))
+        with open(self.path + '.summary.txt', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def close(self):
+        """Print the summary and close the trace."""
+        if not self.enabled:
+            return
+        self.summary()
+        os.close(self.fd)
+        self.fd = None
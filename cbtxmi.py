@@ -0,0 +1,172 @@
+"""One parsed XMI per tape, shared by cbt-analyzer.py and process-local-cbtzips.py.
+
+xmi.list_all(), xmi.open_file() and json.loads(get_json()) all parse the whole XMI
+again (and get_json() deep-copies and serializes everything on top of that). An
+XMIHandle parses the file once and reads the metadata straight from the parsed
+object, exposed as typed fields:
+
+    handle = XMIHandle('/tmp/FILE100.XMI')
+    ds = handle.dataset          # XMIDataset or None if there's no dataset name
+    ds.dsnam, ds.dsorg, ds.lrecl, ds.recfm
+    for name, member in ds.members.items():
+        member.mimetype, member.ext, member.ispf
+    handle.extract_all('/tmp')
+
+Author:
+    Wizard of z/OS
+
+Version:
+    1.0 : Inital Version
+    1.1 : XMIHandle(data=...) parses XMI bytes without touching a file
+    1.2 : write_member() to write members straight to their destination
+"""
+from dataclasses import dataclass, field
+
+import xmi
+
+
+@dataclass
+class Member:
+    """A PDS member as the xmi library sees it."""
+    name: str
+    mimetype: str = 'application/octet-stream'  # force it :)
+    datatype: str = 'binary'
+    ext: str = '.bin'
+    ispf: dict = None  # ISPF stats (version, createdate, modifydate, lines, newlines, user), None if there are none
+    alias: bool = False
+
+
+@dataclass
+class XMIDataset:
+    """The dataset in an XMI with the bits we care about."""
+    dsnam: str
+    dsorg: str
+    lrecl: int
+    recfm: str = 'n.a.'      # DS1RECFM from COPYR1, 'n.a.' for sequential files
+    inmrecfm: str = ''       # RECFM from the INMR02 record
+    blksize: int = 0
+    pdstype: str = ''        # COPYR1 type (PDS/PDSE), empty for sequential files
+    members: dict = field(default_factory=dict)  # name -> Member, empty for sequential files
+
+    @property
+    def is_pds(self):
+        return self.dsorg != 'PS'
+
+
+class XMIHandle:
+    """An XMI file (or XMI bytes) parsed once.
+
+    Args:
+        path (string, optional): XMI file to parse
+        data (bytes, optional): XMI bytes to parse instead of a file
+
+    Raises:
+        Exception: whatever the xmi library raises when this is no XMI
+    """
+
+    def __init__(self, path=None, data=None):
+        self.path = path
+        self.obj = xmi.XMIT(filename=path, quiet=True)
+        if data is not None and self.obj.filetype_is_xmi(data[0:10]):
+            # XMIT.open() passes XMI bytes on to parse_xmi(), which then goes and
+            # reads self.filename anyway. So we do what open() does, minus that.
+            self.obj.xmit = {}
+            self.obj.set_file_object(data)
+            self.obj.parse_xmi()
+            self.obj.get_xmi_files()
+        else:
+            if data is not None:
+                self.obj.set_file_object(data)
+            self.obj.open()
+        self.raw = self.obj.xmit if self.obj.xmit else self.obj.tape
+        self._dataset = False
+
+    @property
+    def files(self):
+        """Names of the datasets in the XMI."""
+        return list(self.raw.get('file', {}))
+
+    @property
+    def contents(self):
+        """Same as xmi.list_all(): 'DSN(MEMBER)' for PDS members, 'DSN' for sequential files."""
+        contents = []
+        for f in self.files:
+            if 'members' in self.raw['file'][f]:
+                contents += [f"{f}({m})" for m in self.raw['file'][f]['members']]
+            else:
+                contents.append(f)
+        return contents
+
+    def inmr02(self, n=1):
+        """The n-th INMR02 control record (INMDSNAM, INMDSORG, INMLRECL, INMRECFM, INMBLKSZ, ...)."""
+        return self.raw['INMR02'][n]
+
+    @property
+    def dataset(self):
+        """XMIDataset for the transmitted dataset, None if there's no dataset name in the XMI."""
+        if self._dataset is False:
+            self._dataset = self._build_dataset()
+        return self._dataset
+
+    def _build_dataset(self):
+        try:
+            dsnam = self.raw['INMR02'][1]['INMDSNAM']
+        except (KeyError, IndexError):
+            try:
+                dsnam = self.raw['INMR02'][2]['INMDSNAM']
+            except (KeyError, IndexError):
+                return None
+        inmr02 = self.raw['INMR02'][1]
+        ds = XMIDataset(dsnam=dsnam,
+                        dsorg=inmr02['INMDSORG'],
+                        lrecl=inmr02['INMLRECL'],
+                        inmrecfm=inmr02.get('INMRECFM', ''),
+                        blksize=inmr02.get('INMBLKSZ', 0))
+        dsfile = self.raw['file'].get(dsnam, {})
+        if 'COPYR1' in dsfile:
+            ds.recfm = dsfile['COPYR1'].get('DS1RECFM', 'n.a.')
+            ds.pdstype = dsfile['COPYR1'].get('type', '')
+        if ds.is_pds:
+            ds.members = self.members(dsnam)
+        return ds
+
+    def members(self, dsn=None):
+        """Members of a PDS in the XMI (defaults to the first dataset).
+
+        Returns:
+            dict: name -> Member, empty for sequential files
+        """
+        dsfile = self.raw['file'].get(dsn or self.files[0], {})
+        members = {}
+        for m, info in dsfile.get('members', {}).items():
+            members[m] = Member(name=m,
+                                mimetype=info.get('mimetype', 'application/octet-stream'),
+                                datatype=info.get('datatype', 'binary'),
+                                ext=info.get('extension', '.bin'),
+                                ispf=info.get('ispf') or None,
+                                alias=info.get('alias', False))
+        return members
+
+    def member_data(self, member, dsn=None):
+        """Raw bytes of a member (e.g. a nested XMI or zip), without writing anything to disk."""
+        dsn = dsn or self.files[0]
+        if self.obj.is_alias(dsn, member):
+            member = self.obj.get_alias(dsn, member)
+        return self.obj.get_member_binary(dsn, member)
+
+    def write_member(self, member, dest, dsn=None):
+        """Write one member to file dest, decoded the same way extract_all() does it
+        (text as utf-8, everything else as is). Aliases get the data of their member."""
+        data = self.obj.get_member_decoded(dsn or self.files[0], member)
+        if isinstance(data, str):
+            with open(dest, 'w') as f:
+                f.write(data)
+        else:
+            with open(dest, 'wb') as f:
+                f.write(data)
+
+    def extract_all(self, into):
+        """Extract everything into folder `into` (same as the xmi library does it)."""
+        self.obj.set_output_folder(into)
+        self.obj.set_quiet(True)
+        self.obj.extract_all()
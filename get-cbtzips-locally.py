@@ -1,35 +1,38 @@
 #!/bin/env python
 """Downloads (and refreshes) all CBT-files from cbttape.org to your local machine.
 Initial download of all takes about 3.5 minutes.
-Refresh without any new or updated files takes abount 90 seconds.
+Refresh without any new or updated files takes a few seconds (one listing of pub/cbt and pub/updates).
 Don't go beyond 15 simultaneous threads when downloading as ftp.cbttape.org doesn't really like that.
 
 Usage:
-    ./usage: get-cbtzips-locally.py [-h] [--stage STAGE] [--threads THREADS] [--pickle PICKLE] [--force] [--updates]
+    ./usage: get-cbtzips-locally.py [-h] [--stage STAGE] [--pool POOL] [--adaptive] [--catalog CATALOG] [--force] [--updates] [--changes CHANGES] [--server SERVER] [--trace TRACE]
     options:
     -h, --help         show this help message and exit
     --stage STAGE      Full path to stage-foler. 
                         This is where all files from cbttape.org are staged.
                         Defaults to {cwd}/stage
-    --threads THREADS  Simultaneous FTP threads for downloads. Defaults to 15
-    --pickle PICKLE    Panda pickle file to save CBT's UPDATESTOC.txt information to. Defaults to {cwd}/cbt.pkl
-    --force            Ingore filesizes, always download everything.
+    --pool POOL        Size of the pool of logged-in FTP sessions used for downloads. Defaults to 15
+                        (--threads is still accepted as an alias)
+    --adaptive         Tune the number of simultaneous downloads (up to --pool) to what the server
+                        handles. Starts at the level that was chosen last run ({stage}/.adaptive.json)
+    --catalog CATALOG  Catalog (SQLite, see cbtcatalog.py) to save CBT's UPDATESTOC.txt information to. Defaults to ./.cbt.sqlite
+    --force            Ingore filesizes and dates, always download everything.
     --updates          Only check and download the updates from cbttape.org.    
+    --changes CHANGES  Change set of this run (see cbttoc.py), merged into the one that's there when
+                        process-local-cbtzips.py --changes didn't consume it yet. Not written without it
+    --server SERVER    FTP server (host or host:port) to download from. Defaults to ftp.cbttape.org
+                        (bench-cbtzips-download.py points this to a local stand-in)
+    --trace TRACE      Append timings per tape and stage to this JSONL file and print a summary (see cbttrace.py)
 
-Data from UPDATESTOC.txt is parsed and stored in a Pandas DataFrame
+Data from UPDATESTOC.txt is parsed into a Pandas DataFrame, together with the remote
+size and modify time from one MLSD (or LIST) of pub/cbt and pub/updates, and stored in
+the tapes table of the catalog:
 
-     cbtnum                     path                                            comment  updated      info
-0       001   pub/updates/CBT001.zip           CBT DOC - Final File 001 for Version 504     True  DOC FILE
-1       002       pub/cbt/CBT002.zip  CBT973 Compression-Decompression Program for F...    False  DOC FILE
-2       003       pub/cbt/CBT003.zip          JCL member to load each tape file to disk    False  DOC FILE
-3       004       pub/cbt/CBT004.zip      Put ./ ADD cards into this file to make a PDS    False  DOC FILE
-4       005       pub/cbt/CBT005.zip          VMREXX exec to load CBT tape to VM - V2.0    False  DOC FILE
-...     ...                      ...                                                ...      ...       ...
-1035   1036  pub/updates/CBT1036.zip     OS/360 Sort/Merge fixed by Tom Armstrong w/doc     True  DOC FILE
-1036   1037  pub/updates/CBT1037.zip  Disassembler from Gerhard Postpischil and T.Ar...     True  DOC FILE
-1037   1038  pub/updates/CBT1038.zip     System Rexx to Modify the Linklist dynamically     True  DOC FILE
-1038   1039  pub/updates/CBT1039.zip    Version of the LOOK storage browser for MVS 3.8     True  DOC FILE
-1039   1040  pub/updates/CBT1040.zip  Frank Clarke execs-enhance PL/I listings and s...     True  DOC FILE
+     cbtnum                     path                                            comment  updated      info       size          modify
+0       001   pub/updates/CBT001.zip           CBT DOC - Final File 001 for Version 504     True  DOC FILE      12345  20230312101500
+1       002       pub/cbt/CBT002.zip  CBT973 Compression-Decompression Program for F...    False  DOC FILE     234567  20110101000000
+...     ...                      ...                                                ...      ...       ...        ...             ...
+1039   1040  pub/updates/CBT1040.zip  Frank Clarke execs-enhance PL/I listings and s...     True  DOC FILE     345678  20230401080000
 
 
 Author:
@@ -39,17 +42,25 @@ Version:
     1.0 : Inital Version
     1.1 : Added some argparsing
     1.2 : More docs (I'll thank myself later)
-
-Todo:
-    - Use MLSD to parse full list and get remote dates. Stick in pandas dataframe as column
+    1.3 : Reuse a pool of logged-in FTP sessions instead of a new login per file
+    1.4 : One MLSD listing for remote sizes/dates instead of a SIZE per file
+    1.5 : Downloads go to a .part file (resumed with REST) and are renamed into place
+    1.6 : Stage manifest ({stage}/.manifest.json) with size, remote modify time and sha256 per zip
+    1.7 : Bounded executor instead of polling threading.active_count(), errors from downloads are reported
+    1.8 : --adaptive, AIMD tuned concurrency that backs off on 421s, refusals and timeouts
+    1.9 : --server, so we can benchmark against a local FTP server
+    2.0 : Compiled TOC parser, streamed straight from FTP, and a change set against the previous catalog
+    2.1 : Zips are verified after download, broken ones are quarantined ({stage}/.quarantine) and retried
+    2.2 : Catalog in SQLite (--catalog, shared with the other scripts) instead of a pickle
+    2.3 : --trace, timings per download and stage
 """
 from ftplib import FTP
-import parse
 import re
 import pandas as pd
 import os
 import zipfile, io 
 import xmi
+import json
 import time
 import datetime
 
@@ -57,62 +68,119 @@ import subprocess
 import glob
 
 import math
-import threading 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import argparse 
 
+from cbtftp import FTPPool, AdaptiveLimiter, CorruptDownload, remote_state, download
+from cbtmanifest import StageManifest
+from cbttoc import TOC_COLUMNS, parse_toc_line, changeset, save_changeset, load_changeset, merge_changesets
+from cbtcatalog import Catalog, CATALOG
+from cbttrace import Tracer
+
 
 parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter, description="""Collect and keep a local copy of all the files from cbttape.org.
 All the zipfiles are stored in the path you specify with --stage. 
-Files are downloaded to the stage folder, if the remote (ftp.cbttape.org) file size differs to what's in the stage folder.""")
+Files are downloaded to the stage folder, if the remote (ftp.cbttape.org) file size or modify time differs to what's recorded in the stage manifest.""")
 parser.add_argument("--stage", type=str,
                     default=f'{os.getcwd()}/stage',
                     help=f"""Full path to stage-foler. 
 This is where all files from cbttape.org are staged.
 Defaults to {os.getcwd()}/stage""")
 
-parser.add_argument("--threads", type=int,
+parser.add_argument("--pool", "--threads", type=int, dest="pool",
                     default=15,
-                    help=f"""Simultaneous FTP threads for downloads. Defaults to 15""")
+                    help=f"""Size of the pool of logged-in FTP sessions used for downloads. Defaults to 15""")
+
+parser.add_argument("--adaptive",
+                    action="store_true",
+                    help=f"""Tune the number of simultaneous downloads (up to --pool) to what the server handles.
+Starts at the level that was chosen last run""")
 
-parser.add_argument("--pickle", type=str,
-                    default=f'.cbt.pkl',
-                    help=f"""Panda pickle file to save CBT's UPDATESTOC.txt information to. Defaults to ./cbt.pkl""")
+parser.add_argument("--catalog", type=str,
+                    default=CATALOG,
+                    help=f"""Catalog (SQLite, see cbtcatalog.py) to save CBT's UPDATESTOC.txt information to. Defaults to ./{CATALOG}""")
 
 
 
 parser.add_argument("--force",
                     action="store_true",
-                    help=f"Ingore filesizes, always download everything.")
+                    help=f"Ingore filesizes and dates, always download everything.")
 
 parser.add_argument("--updates",
                     action="store_true",
                     help=f"Only check and download the updates from cbttape.org.")
 
 
+parser.add_argument("--changes", type=str,
+                    default='',
+                    help=f"""Where to write the change set (added/removed/changed tapes compared to the catalog
+from the previous run, and what got downloaded), e.g. ./.cbt.changes.json. When process-local-cbtzips.py --changes
+didn't consume the one that's there yet, this run gets merged into it. No change set without it""")
+
+parser.add_argument("--server", type=str,
+                    default='ftp.cbttape.org',
+                    help=f"FTP server (host or host:port) to download from. Defaults to ftp.cbttape.org")
+
+parser.add_argument("--trace", type=str,
+                    default='',
+                    help=f"Append timings per tape and stage to this JSONL file and print a summary at the end (see cbttrace.py)")
+
 args = parser.parse_args()
 
-MAX_THREAD_DOWNLOADS = args.threads
+MAX_THREAD_DOWNLOADS = args.pool
 stage = args.stage
 
 os.system(f"mkdir -p {stage}")
 
-def threaded_download(remotefile,storeat,ftpserver):
-    """Do a threaded download.
+adaptivefile = f"{stage}/.adaptive.json"
+
+def threaded_download(remotefile,storeat,pool,size=-1,modify='',retries=2):
+    """Do a threaded download on a session from the pool and record it in the manifest.
+    Interrupted transfers are resumed from storeat.part on the retry (or the next run).
+    Corrupt zips are quarantined by download() and fetched again from scratch.
 
     Args:
         remotefile (string): remote filename
         storeat (string): local filename
-        ftpserver (string): ftp server to download from
+        pool (FTPPool): pool of logged-in sessions to download with
+        size (int, optional): remote filesize. Defaults to -1 (unknown)
+        modify (string, optional): remote modify time (YYYYMMDDHHMMSS). Defaults to ''
+        retries (int, optional): extra attempts for corrupt zips. Defaults to 2
+
+    Returns:
+        int: bytes transferred
     """
-    ftpt = FTP(ftpserver)
-    ftpt.login()
-    with open(storeat, 'wb+') as fp:
-        ftpt.retrbinary(f"RETR {remotefile}", fp.write)
+    result = {}
+    started = time.perf_counter()
+    def transfer():
+        result['bytes'], result['sha256'] = pool.run(lambda ftpt: download(ftpt, remotefile, storeat, size=size))
+        return result['bytes']
+    for attempt in range(retries + 1):
+        try:
+            if limiter:
+                limiter.run(transfer)
+            else:
+                transfer()
+            break
+        except CorruptDownload:
+            if attempt == retries:
+                raise
+    transferred, sha256 = result['bytes'], result['sha256']
+    tracer.record(os.path.basename(storeat)[3:].split('.')[0], 'ftp', time.perf_counter() - started, transferred)
+    manifest.record(os.path.basename(storeat), remotefile, os.stat(storeat).st_size, modify, sha256)
+    # right away, an interrupted run must not leave the new zip with the old sha256
+    manifest.save()
+    downloaded.append(os.path.basename(storeat)[3:].split('.')[0])
+    return transferred
 
 def processthem(df, force=False):
-    """Process all files from dataframe. Check if filesizes differ
-    and fire a threaded download if they do. Overruled by force
+    """Process all files from dataframe. Check if remote size and modify time (the 'size' and
+    'modify' columns, filled from the bulk listing) differ from the stage manifest and queue a
+    download if they do. Overruled by force.
+    Downloads run on a bounded executor (one worker per pool session), the next one starts
+    as soon as a worker is free. With --adaptive the limiter decides how many of those
+    workers may transfer at the same time. Errors from the workers are collected and returned.
 
     Args:
         df (DataFrame): CBTTAPE DataFrame
@@ -121,101 +189,105 @@ def processthem(df, force=False):
     Returns:
         array: Any encountered errors
     """
-    threads = []
     errors = []
-    i = 0
+    todownload = []
     for index,data in df.iterrows():
-        fname = data['path']
-        i += 1
-        pct = math.floor((i/len(df))*100) 
-        done = math.floor((pct/100)*40)
-        todo = 40 - done
-        done = done * "✅" 
-        todo = todo * "🟩"
-        try:
-            # looks weird to check size even if we can force, but this way we no need error handling in thread :)
-            filesize_remote = ftp.size(data['path'])
-        except:
+        # size comes from the MLSD listing, -1 means it wasn't in there
+        if data['size'] < 0:
             errors.append(f"{data['path']} not present on server (but is in TOC!), skipping..")
             continue
-        if force:
-            filesize_remote = -10
-        stagefile = f"{stage}/{data['path'].split('/')[-1]}"
-        try:
-            filesize_local  = os.stat(stagefile).st_size
-        except:
-            filesize_local = 0
-
-        if filesize_local != filesize_remote:
-                print(f'{done}{todo} {fname} ({pct}%) [downloading, active threads={threading.active_count()}]', end='\r', flush=True)
-                while threading.active_count() >= MAX_THREAD_DOWNLOADS:
-                    time.sleep(0.5) # give it some rest :) 
-                t = threading.Thread(target=threaded_download,args=(data['path'],stagefile,ftpserver))
-                threads.append(t)
-                t.start()
-
-        else:
-            print(f'{done}{todo} {fname} ({pct}%) [up-to-date , active threads={threading.active_count()}]', end='\r', flush=True)
-
-    while threading.active_count() > 1:
-        print(f'{done}{todo} {fname} ({pct}%) [waiting to finish {threading.active_count()} active threads]  ', end='\r', flush=True)
-        time.sleep(0.5)
+        stagename = data['path'].split('/')[-1]
+        if force or not manifest.is_fresh(stagename, data['size'], data['modify']):
+            todownload.append(data)
+
+    print(f'{len(df) - len(todownload)} files up-to-date, {len(todownload)} to download')
+    if not todownload:
+        return errors
+
+    began = time.time()
+    totalbytes = 0
+    succeeded = 0
+    with ThreadPoolExecutor(max_workers=MAX_THREAD_DOWNLOADS) as executor:
+        futures = {}
+        for data in todownload:
+            stagefile = f"{stage}/{data['path'].split('/')[-1]}"
+            f = executor.submit(threaded_download, data['path'], stagefile, pool, data['size'], data['modify'])
+            futures[f] = data['path']
+        for i, f in enumerate(as_completed(futures), start=1):
+            fname = futures[f]
+            try:
+                totalbytes += f.result()
+                succeeded += 1
+            except Exception as e:
+                errors.append(f"{fname} download failed: {e!r}")
+            pct = math.floor((i/len(todownload))*100)
+            done = math.floor((pct/100)*40)
+            todo = 40 - done
+            done = done * "✅"
+            todo = todo * "🟩"
+            print(f'{done}{todo} {fname} ({pct}%) [{i}/{len(todownload)} done]   ', end='\r', flush=True)
+    elapsed = max(time.time() - began, 0.001)
+    print('')
+    if limiter:
+        print(f'Adaptive concurrency ended at {limiter.limit} simultaneous downloads ({limiter.overloads} overloads seen)')
+    print(f'Downloaded {succeeded} files ({len(todownload) - succeeded} failed), {totalbytes/1024/1024:.1f} MB in {elapsed:.1f}s '
+          f'({succeeded/elapsed:.1f} files/s, {totalbytes/1024/1024/elapsed:.2f} MB/s, {pool.opened} FTP connections opened)')
     return errors
         
 
 
 start = time.time()
+tracer = Tracer(args.trace, 'get-cbtzips-locally')
 
-ftpserver = 'ftp.cbttape.org'
+ftpserver = args.server
+ftphost, _, ftpport = ftpserver.partition(':')
 print(f'Connecting to FTP server: {ftpserver}')
-ftp = FTP(ftpserver)
-ftp.login() # per default anonymous :)
-print(f'Anonymous login to {ftpserver} succeeded, retreiving UPDATESTOC.txt')
-with open('updates', 'wb') as fp:
-    ftp.retrbinary('RETR pub/updates/UPDATESTOC.txt', fp.write)
-
-# we now have the updates file
-
-cbtinfo = {}
-for k in ['cbtnum', 'path', 'comment','updated','info']:
-    cbtinfo[k] = []
-
-
-with open('updates') as updt:
-    updates = updt.readlines()
-
-print(f'Reading and parsing downloaded UPDATESTOC.txt')
-for update in updates:
-    # check for weird last line...
-    if len(update) < 5:
-        continue
-    # where's parse var when u need it :)
-    file, comment, updated, info = parse.parse('//*+{}:  {}*{}  {}\n',update)
+pool = FTPPool(ftphost, port=int(ftpport or 21), size=MAX_THREAD_DOWNLOADS)
+manifest = StageManifest(stage)
+downloaded = [] # cbtnums, for the change set
+limiter = None
+if args.adaptive:
+    # start where we ended last time, or carefully at 4
     try:
-        cbtnum = file.split('FILE')[1].strip()
-    except:
-        cbtnum = file.split('File')[1].strip()
-    if updated =='#':
-        updated = True
-        dlpath = f'pub/updates/CBT{cbtnum}.zip'
-    else:
-        updated = False
-        dlpath = f'pub/cbt/CBT{cbtnum}.zip'
-    cbtinfo['cbtnum'].append(cbtnum)
-    cbtinfo['path'].append(dlpath)
-    cbtinfo['comment'].append(comment.strip())
-    cbtinfo['updated'].append(updated)
-    cbtinfo['info'].append(info)
-    
-
-cbt = pd.DataFrame.from_dict(cbtinfo)
-
-
-cbt.to_pickle(f'{args.pickle}')
-print(f'Dataframe saved as {args.pickle}, {len(cbt)} CBT-files indexed')
+        with open(adaptivefile) as f:
+            startlevel = json.load(f)['level']
+    except (FileNotFoundError, ValueError, KeyError):
+        startlevel = 4
+    limiter = AdaptiveLimiter(startlevel, maximum=MAX_THREAD_DOWNLOADS)
+    print(f'Adaptive concurrency, starting at {limiter.limit} (max {MAX_THREAD_DOWNLOADS}) simultaneous downloads')
+print(f'Using a pool of {MAX_THREAD_DOWNLOADS} anonymous sessions to {ftpserver}, retreiving UPDATESTOC.txt')
+def get_toc(ftp):
+    # parse while the lines come in, no need for a temporary file
+    rows = []
+    ftp.retrlines('RETR pub/updates/UPDATESTOC.txt', lambda line: rows.append(parse_toc_line(line)))
+    return [row for row in rows if row]
+
+print(f'Reading and parsing UPDATESTOC.txt')
+with tracer.stage(None, 'toc'):
+    cbt = pd.DataFrame(pool.run(get_toc), columns=TOC_COLUMNS)
+
+# what changed compared to the catalog of the previous run?
+catalog = Catalog(args.catalog)
+previous = catalog.tapes().to_dict('records')
+if not previous and os.path.exists('.cbt.pkl'):
+    # first run with a catalog, compare to the pickle we used to write
+    previous = pd.read_pickle('.cbt.pkl').to_dict('records')
+changes = changeset(previous, cbt.to_dict('records'))
+print(f"Catalog changes: {len(changes['added'])} added, {len(changes['removed'])} removed, "
+      f"{len(changes['flag_changed'])} update flags and {len(changes['comment_changed'])} comments changed")
+
+print(f'Listing pub/cbt and pub/updates on {ftpserver}')
+with tracer.stage(None, 'listing'):
+    remote = pool.run(lambda ftp: remote_state(ftp, ['pub/cbt', 'pub/updates']))
+cbt['size']   = [remote[p]['size'] if p in remote else -1 for p in cbt.path]
+cbt['modify'] = [remote[p]['modify'] if p in remote else '' for p in cbt.path]
+
+catalog.replace_tapes(cbt.to_dict('records'))
+catalog.close()
+print(f'Catalog saved as {args.catalog}, {len(cbt)} CBT-files indexed')
 
 if args.force:
-    extra = "(forcing download, not comparing remote/local filesizes)"
+    extra = "(forcing download, not comparing remote/local filesizes and dates)"
 else:
     extra = ''
 
@@ -230,11 +302,29 @@ if len(errors) > 0:
 if not args.updates:
     rest   = cbt.loc[cbt.updated==False]
     print(f'Processing {len(rest)} files without the update flag {extra}')
-    processthem(rest,force=args.force)
+    errors = processthem(rest,force=args.force)
     print('')
-
-
+    if len(errors) > 0:
+        print("Some errors occured.")
+        print('\n'.join(errors))
+
+
+pool.close()
+manifest.save()
+changes['downloaded'] = sorted(downloaded)
+# only when asked for, nobody would ever consume it otherwise
+if args.changes:
+    if os.path.exists(args.changes):
+        # not processed yet, the tapes in there still need it
+        changes = merge_changesets(load_changeset(args.changes), changes)
+        print(f'Change set merged into the unprocessed {args.changes}')
+    save_changeset(changes, args.changes)
+    print(f'Change set saved as {args.changes}')
+if limiter:
+    with open(adaptivefile, 'w') as f:
+        json.dump({'level': limiter.limit, 'date': datetime.datetime.now().isoformat()}, f)
 stop = time.time()
 
 print(f'All requested CBT files updated from cbttape.org into {args.stage}')
 print(f'This operation took {datetime.timedelta(seconds=stop-start)}')
+tracer.close()
@@ -6,12 +6,14 @@ import re
 import pandas as pd
 import os
 import zipfile, io 
-import xmi, json
+import json
+import hashlib
 import time
 import datetime
 
 import subprocess
 import glob
+import shutil
 
 import math
 import yaml
@@ -21,13 +23,21 @@ import argparse
 import subprocess 
 
 import pprint
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from cbtcatalog import Catalog, CATALOG
+from cbtsearch import SearchIndex, SEARCHINDEX, repo_members
+from cbttrace import Tracer
+from cbtgit import fast_import_commit
+from cbtsync import GitHubSync
 
 
 parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter, description="""Create, or update a GitHub profile with data from CBTTape.org.
 
     1. Step One: Extract all CBTTapes and create GitHub Repo if needed.
-       Process all files that were downloaded from cbttape.org. All the zipfiles stored in the path you specify with --stage. are processed. They are copied to the --cbtrepos folder if
-they're new. If they're the same as  what's already present there, nothing happens :) Otherwise, they're new a repote repo
+       Process all files that were downloaded from cbttape.org. All the zipfiles stored in the path you specify with --stage. are processed if
+their sha256 (from the stage manifest) differs from the one we processed last time. If it's the same, nothing happens :) Otherwise, they're new a repote repo
 at GITHUB_NAME_OR_ORG from config.yaml will be created.
 Zip files are expaned to their containing PDS/SEQ. This PDS will be scanned, nested XMIT files will be expanded into the repo too.
 Binary files that do not resolve to a (paritioned) sequential file will be stored as a new xmit in the /xmits folder.""")
@@ -41,7 +51,7 @@ Defaults to {os.getcwd()}/stage""")
 parser.add_argument("--cbtfiles", type=str,
                     default=f'.cbtfiles',
                     help=f"""Full path to the cbtfiles. 
-This is all up-to-date zip files (if you ran --update).
+This is where we keep processed.json, the sha256 of every zip at the time it was processed.
 Defaults to {os.getcwd()}/.cbtfiles""")
 
 parser.add_argument("--repos", type=str,
@@ -53,9 +63,15 @@ parser.add_argument("--only", type=int,
                     default=0,
                     help=f"""Only process this CBT Tape""")
 
-parser.add_argument("--pickle", type=str,
-                    default=f'.cbt.pkl',
-                    help=f"""Panda pickle file with parsed UPDATESTOC.txt information. Will be updated during this run. Defaults to .cbt.pkl""")
+parser.add_argument("--catalog", type=str,
+                    default=CATALOG,
+                    help=f"""Catalog (SQLite, see cbtcatalog.py) with parsed UPDATESTOC.txt information from get-cbtzips-locally.py. Defaults to {CATALOG}""")
+
+parser.add_argument("--changes", type=str,
+                    default='',
+                    help=f"""Change set from get-cbtzips-locally.py --changes (e.g. .cbt.changes.json). When given, only the tapes in there
+are looked at (added, update flag changed or downloaded) and repo descriptions are updated for changed comments.
+Afterwards only the tapes that didn't make it are left in the file, it's removed when that's none of them""")
 
 parser.add_argument("--clean",
                     action="store_true",
@@ -65,6 +81,33 @@ parser.add_argument("--force",
                     action="store_true",
                     help=f"Ingore filesizes, always download everything.")
 
+parser.add_argument("--search", type=str,
+                    default=SEARCHINDEX,
+                    help=f"""Full-text search index (see cbtsearch.py and search-cbtrepos.py). Every converted tape
+replaces its members in there. Defaults to {SEARCHINDEX}""")
+
+parser.add_argument("--noindex",
+                    action="store_true",
+                    help=f"Don't update the search index")
+
+parser.add_argument("--trace", type=str,
+                    default='',
+                    help=f"Append timings per tape and stage to this JSONL file and print a summary at the end (see cbttrace.py)")
+
+parser.add_argument("--workers", type=int,
+                    default=1,
+                    help=f"""Convert this many tapes in parallel (process pool, every tape only touches its own repo folder).
+GitHub API calls still happen one at a time (see cbtsync.py). Defaults to 1""")
+
+parser.add_argument("--pushers", type=int,
+                    default=4,
+                    help=f"""Push this many repos to GitHub at the same time, all over one SSH connection. Defaults to 4""")
+
+parser.add_argument("--fastimport",
+                    action="store_true",
+                    help=f"""Commit the converted tapes with one git fast-import stream (see cbtgit.py) instead of
+git add + git commit. Same commits, without hashing the working tree into an index first""")
+
 parser.add_argument("--noremote",
                     action="store_true",
                     help=f"Do everything, except remote GitHub actions. (doen't create or updates repos")
@@ -79,8 +122,9 @@ repos    = args.repos
 stage    = args.stage
 only     = args.only
 cbtfiles = args.cbtfiles
-pickle   = args.pickle
 noremote = args.noremote
+workers  = args.workers
+fastimport = args.fastimport
 
 docmimetypes = ['application/msword', 'application/epub+zip', 'application/pdf', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document','application/vnd.oasis.opendocument.text','application/vnd.oasis.opendocument.text','application/vnd.ms-powerpoint','application/vnd.ms-excel','application/vnd.openxmlformats-officedocument.presentationml.presentation']
 
@@ -102,7 +146,8 @@ GITHUB_USER_OR_ORG = config['github']['name']
 
 
 from github import Github
-github = Github(GITHUB_TOKEN)
+# 100 per page, so listing all the repos (see cbtsync.py) takes as few calls as it can
+github = Github(GITHUB_TOKEN, per_page=100)
 me = github.get_organization(GITHUB_USER_OR_ORG)
 
 
@@ -121,13 +166,90 @@ else:
 
 
 
+def remove(path):
+    """rm -rf path, without the shell. Gone already is fine."""
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def move(src, dst):
+    """mv src dst, without the shell. A dst that's already there gets replaced
+    (mv would put a folder inside of it, which is not what we ever want)."""
+    if os.path.abspath(src) == os.path.abspath(dst):
+        return
+    if os.path.isdir(dst) and not os.path.islink(dst):
+        shutil.rmtree(dst)
+    os.replace(src, dst)
+
+
+def write_if_changed(path, data):
+    """Write data (str or bytes) to path, unless that's what's in there already. Untouched
+    files keep their mtime, so git doesn't even look at them again.
+
+    Returns:
+        bool: True if the file got written
+    """
+    if isinstance(data, str):
+        data = data.encode()
+    try:
+        with open(path, 'rb') as f:
+            if f.read() == data:
+                return False
+    except OSError:
+        pass
+    with open(path, 'wb') as f:
+        f.write(data)
+    return True
+
+
+# what the last conversion wrote into a repo, kept out of the repo itself
+MANIFEST = '.git/cbt2git-manifest.json'
+
+
+def load_manifest(repopath):
+    """Manifest of the last conversion of this repo.
+
+    Returns:
+        dict: path in repo -> {'sha256', 'mimetype'} of the member it was written from (None for
+              everything that's not a plain member), None when there's no (usable) manifest
+    """
+    try:
+        with open(f'{repopath}/{MANIFEST}') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('version') != 1:
+        return None
+    return manifest['files']
+
+
+def save_manifest(repopath, files):
+    with open(f'{repopath}/{MANIFEST}', 'w') as f:
+        json.dump({'version': 1, 'files': files}, f, indent=1, sort_keys=True)
+
+
+def git(repopath, *args, input=None):
+    """Run a git command in repopath, without the shell.
+
+    Returns:
+        string: what git complained about when it failed, None when it worked
+    """
+    res = subprocess.run(['git', *args], cwd=repopath, capture_output=True, text=True, input=input)
+    if res.returncode != 0:
+        # on one line, the full log gets sorted line by line
+        said = ' / '.join(line.strip() for line in (res.stderr or res.stdout).splitlines() if line.strip())
+        return f"git {args[0]} failed ({res.returncode}): {said}"
+    return None
+
 
 if args.clean:
     """Removes all local and remote repositories. 
     Basically a full hard reset
     """
-    os.system(f'rm -rf {cbtfiles}/*')
-    os.system(f'rm -rf {repos}/*')
+    for p in glob.glob(f'{cbtfiles}/*') + glob.glob(f'{repos}/*') + glob.glob(f'{args.search}*'):
+        remove(p)
     if not noremote:
         print(f"{me.get_repos().totalCount} Repos ...")
         while me.get_repos().totalCount > 1:
@@ -158,10 +280,10 @@ if not os.path.isdir(cbtfiles):
 
 
 
-cbt = pd.read_pickle(pickle)
+cbt = Catalog(args.catalog).tapes()
 print(f'Loaded our dataframe, {len(cbt)} CBT-files ready to be processed')
 
-def ispfstatsfromxmi(mbr, xmijson):
+def ispfstatsfromxmi(mbr, xmijson, alerts, cbtnum):
     if xmijson:
         crdat = xmijson['createdate'].split('T')[0][2:].replace('-','/')
         if xmijson['modifydate'] != '':
@@ -178,7 +300,7 @@ def ispfstatsfromxmi(mbr, xmijson):
         user   = xmijson['user']
     else:
         # weird that we need this? Probably calling ispfstatsfromxmi too eagerly?
-        fulllog.append(f"{datetime.datetime.now()} - ** ALERT CBT{cbtnum} ** {mbr} no ispfstats from xmi?" + "\n")
+        alerts.append(f"{datetime.datetime.now()} - ** ALERT CBT{cbtnum} ** {mbr} no ispfstats from xmi?" + "\n")
         return f"{mbr:<8}"
     ispfline =  f"{mbr:<8} {crdat} {mddat} {v:>2} {m:>2} {mdtime} {olines:>5} {nlines:>5} {0:>5} {user}"
     return ispfline 
@@ -198,71 +320,63 @@ def attribfile(path):
     with open(f'{path}/.gitattributes', 'w') as a:
         a.writelines(lines)
 
-def getxmidata(xmifile):
-    xmijson = json.loads(xmi.open_file(xmifile,quiet=True).get_json())
-    try:
-        dsnam = xmijson['INMR02']['1']['INMDSNAM']
-    except:
-        try:
-            dsnam = xmijson['INMR02']['2']['INMDSNAM']
-        except:
-            return False, False, False, False, False
-    dsorg = xmijson['INMR02']['1']['INMDSORG']
-    lrecl = xmijson['INMR02']['1']['INMLRECL']
-    if dsorg != "PS":
-        mbrs = [x for x in xmijson['file'][dsnam]['members']]
-    else:
-        mbrs = []
-    try:
-        recfm  = xmijson['file'][dsnam]['COPYR1']['DS1RECFM']
-    except:
-        recfm = 'n.a.'
-    members = {}
-    for m in mbrs:
-        if 'mimetype' in xmijson['file'][dsnam]['members'][m]:
-            mt = xmijson['file'][dsnam]['members'][m]['mimetype']
-        else:
-            mt = 'application/octet-stream' # force it :)
-        if 'datatype' in xmijson['file'][dsnam]['members'][m]:
-            dt = xmijson['file'][dsnam]['members'][m]['datatype']
-        else:
-            dt = 'binary'
-        if 'extension' in xmijson['file'][dsnam]['members'][m]:
-            ext = xmijson['file'][dsnam]['members'][m]['extension']
-        else:
-            ext = '.bin'
-        members[m] = {'mimetype': mt, 'datatype':dt,'ext':ext}
-    return dsnam, dsorg, lrecl, recfm, members
 
 
 
 
 
 
-import filecmp
-import shutil
+from cbtmanifest import StageManifest
+from cbttoc import changeset, load_changeset, save_changeset, consume_changeset, changed_tapes
+from cbtxmi import XMIHandle
 
 toprocess= []
 
+searchindex = None if args.noindex else SearchIndex(args.search)
+tracer = Tracer(args.trace, 'process-local-cbtzips')
+
+# sha256 per zip when we last processed it, compared to the stage manifest to see what changed
+manifest = StageManifest(stage)
+processedfile = os.path.join(cbtfiles, 'processed.json')
+try:
+    with open(processedfile) as f:
+        processed = json.load(f)
+except FileNotFoundError:
+    processed = {}
+
+changes = None
+if args.changes:
+    # no file, the last change set was consumed already and nothing changed since
+    changes = load_changeset(args.changes) if os.path.exists(args.changes) else changeset([], [])
+if changes:
+    candidates = changed_tapes(changes)
+    print(f"Change set {args.changes}: {len(candidates)} tapes to look at")
 
 flist = os.listdir(stage)
+toprocess_sha256 = {}
 
 for i,filename in enumerate(flist):
+    # skip half-downloaded .part files and other non-zips
+    if not filename.endswith('.zip'):
+        continue
     # I've we selected a CBT, oly do that one
     if only > 0:
         cbtn = f"CBT{only:003d}.zip" 
         if filename != cbtn: 
             continue
+    # with a change set we don't even look at the rest
+    if changes and filename[3:].split('.')[0] not in candidates:
+        continue
     # otherwise process this src CBT file..
     src = os.path.join(stage, filename)
     # checking if it is a file
     if os.path.isfile(src):
-        dst = os.path.join(cbtfiles, filename)
-        # copy to destintation if new or different
-        if not os.path.exists(dst) or not filecmp.cmp(src, dst):
-            shutil.copyfile(src, dst)
-            # and add to our list of things to do :)
-            toprocess.append(dst)
+        sha256 = manifest.sha256(filename)
+        # process if new or different
+        if processed.get(filename) != sha256:
+            # and add to our list of things to do :) (processed gets the sha once it's done, see converted())
+            toprocess.append(src)
+            toprocess_sha256[src] = sha256
     else:
         print(f"Sorry, {src} not found. This really shouldn't happen.")
 
@@ -282,380 +396,496 @@ def replace_pds(reponame, pdsfolder, member, ext, newmember, newnestpds):
         xmipds.write(f"# |{(reponame + '/' + member + ext).center(55)}" + "|\n") 
         xmipds.write(f"# +-------------------------------------------------------+" + "\n")
 
-for i,z in enumerate(toprocess):
-    cbtnum = z.split('/CBT')[1].split('.')[0]
-    pct = math.floor((i/len(toprocess))*100) 
-    done = math.floor((pct/100)*40)
-    todo = 40 - done
-    done = done * "✅" 
-    todo = todo * "🟩"
-    print(f'{done}{todo} {z} ({pct}%)', end='\r', flush=True)
+def convert_tape(z):
+    """Convert one CBT zip into its local repo ({repos}/CBTnnn), local git add/commit included.
+    Everything happens in memory or inside that repo folder, so a bunch of these can run
+    at the same time (--workers).
+
+    An existing repo with a manifest from the last conversion (load_manifest()) gets an
+    incremental update: plain members whose data didn't change are not written again, whatever
+    the last conversion wrote that isn't there anymore is deleted, and only what changed is staged.
+
+    Args:
+        z (string): path to CBTnnn.zip
+
+    Returns:
+        dict: cbtnum, reponame, repopath, converted (True if the repo got updated),
+              ok (converted and committed without git errors, so no need to look at it again),
+              unusable (why this zip can never be converted, no need to look at it again either),
+              loglines and alerts (both end up in fulllog)
+    """
+    cbtnum = z.split('/CBT')[-1].split('.')[0]
+    reponame = os.path.basename(z).split('.')[0]
+    repopath = repos + "/" + reponame
     dotzigispf = {} # list of lines per PDS in the repo for .zigi/{PDS} files (ISPFSTATS)
     dotzigidsn = [] # list of lines for .zigi/dsn file
     loglines = []
+    alerts = []     # ** ALERT ** lines, these only go to the full log
+    result = {'cbtnum': cbtnum, 'reponame': reponame, 'repopath': repopath, 'converted': False, 'ok': False,
+              'unusable': None, 'loglines': loglines, 'alerts': alerts}
     loglines.append(f'{datetime.datetime.now()} - Initialized conversion of CBT{cbtnum}' + '\n')
+    lap = tracer.laps(cbtnum)
     with zipfile.ZipFile(z, 'r') as zip_ref:
         info =  zip_ref.infolist()
         if len(info) > 1:
             print(F"More than onze file in zip??? {z} => {info}")
-        else:
-            xmifile = f"/tmp/{info[0].filename}"
-            zip_ref.extractall('/tmp')
-            try:
-                contents = xmi.list_all(xmifile)
-            except:
-                fulllog.append(f"{datetime.datetime.now()} - ** ALERT CBT{cbtnum} **  {z} is zipped version of {xmifile} but that's no XMI??" + "\n")
-                continue
-
-            if contents == []:
-                # FILE062 has this too ...
-                fulllog.append(f"{datetime.datetime.now()} - ** ALERT CBT{cbtnum} ** {z} unzipped to {xmifile} but that's not an XMI??" + "\n")
-                continue
+            result['unusable'] = 'more than one file in zip'
+            return result
 
-            pdsfile  = contents[0].split('(')[0]
-
-            try:
-                xmi_obj = xmi.open_file(xmifile,quiet=True)
-            except:
-                fulllog.append(f"{datetime.datetime.now()} - ** ALERT CBT{cbtnum} ** De-XMI error for {z}" + "\n")
-                continue
-
-            xmijson = xmi_obj.get_json()
-            new_repo = False
-            repopath = repos + "/" + z.split('/')[1].split('.')[0]
-            reponame = z.split('/')[1].split('.')[0]
-            if not os.path.isdir(repopath):
-                os.mkdir(repopath)
-                new_repo = True
-            xmi_obj.set_output_folder('/tmp')
-            xmi_obj.set_quiet(True)
-            try:
-                xmi_obj.extract_all()
-            except:
-                fulllog.append(f"{datetime.datetime.now()} - ** ALERT CBT{cbtnum} ** De-XMI error for {z}" + "\n")
-                continue
-            # We have the dexmied file in /tmp/something lets see what's there
-            xmijson = json.loads(xmi_obj.get_json())
-            xmi_file = list(xmijson['file'].keys())[0]
-            xmi_has  = xmijson['file'][xmi_file]['COPYR1']['type']
-            if xmi_has != "PDS":
-                fulllog.append(f"{datetime.datetime.now()} - ** ALERT CBT{cbtnum} ** No PDS in {xmifile}" + "\n")
-                continue
-            loglines.append(f'{datetime.datetime.now()} - Received {pdsfile} from {info[0].filename} ' + '\n')
-            # Create our target PDS-folder in repopath
-            mainpds = xmi_file.split('.')[-1]
-            pdsfolder = repopath + "/" + mainpds # last qualifier should do
-            os.system(f"mkdir -p {pdsfolder}")
-            # add line to the .zigi/dsn file
-            dotzigidsn.append(f'{mainpds} PO FB 80 32720' + "\n")
-            # create placeholder for ISPFSTATS
-            dotzigispf[mainpds] = []
-            for member in xmijson['file'][xmi_file]['members']:
-                # Loop all members in the received PDS from 'main' XMI
-                member_info = xmijson['file'][xmi_file]['members'][member]
-                if 'mimetype' in member_info:
-                    mimetype = member_info['mimetype']
-                else:
-                    mimetype = 'application/octet-stream'
-                if 'extension' in member_info:
-                    ext = member_info['extension']
-                else:
-                    ext = '.bin'
-                newmember = member.split('.')[0]                
-                if mimetype.split('/')[0] == 'text':
-                    # we just copy this over inside our repopath
-                    # usssafe vai the single quotes :)
-                    os.system(f"cp '/tmp/{pdsfile}/{member}{ext}' '{pdsfolder}/{newmember}' > /dev/null 2>&1")
-                    # add the ISPFSTATS 
-                    if not member_info['ispf']:
-                        member_info['ispf'] = {'version': '01.00', 'flags': 0, 'createdate': '1976-06-12T00:00:00.000000', 'modifydate': '1976-06-12T22:18:12.000000', 'lines': 0, 'newlines': 0, 'modlines': 0, 'user': 'CBT2GIT'}
-                    dotzigispf[mainpds].append(ispfstatsfromxmi(member, member_info['ispf'])+"\n")
-                    loglines.append(f'{datetime.datetime.now()} - Found {member}{member_info["extension"]} ({member_info["mimetype"]}) in {pdsfile}, moved to {mainpds}/{member}' + '\n')
-                elif mimetype == 'application/xmit':
-                    # we should assume this has no more nested xmi's and de-xmit it outside of the pds as a new pds
-                    # dexmi, move
-                    nested_content = xmi.list_all(f'/tmp/{pdsfile}/{member}{ext}')
-                    nested_pdsfile  = nested_content[0].split('(')[0] # last two qualifier should do all... 
-                    nested_xmi_obj = xmi.open_file(f'/tmp/{pdsfile}/{member}{ext}',quiet=True)
-                    nested_xmi_obj.set_output_folder(repopath)
-                    try:
-                        nested_xmi_obj.extract_all()
-                    except:
-                         # for 982, the XMI is 'broken' ?
-                        fulllog.append(f"{datetime.datetime.now()} - ** ALERT CBT{cbtnum} ** {pdsfile}/{member}{ext} no ispf data when de-xmi-ing" + "\n")
-                        continue
-                    # skip all but last 2 qualifiers
-                    newnestpds = '.'.join(nested_pdsfile.split('.')[-2:])
-                    loglines.append(f'{datetime.datetime.now()} - Found {member}{member_info["extension"]} ({member_info["mimetype"]}) in {pdsfile}'+ '\n')
-                    # move to correct spot
-                    res = os.system(f'mv {repopath}/{nested_pdsfile} {repopath}/{newnestpds} > /dev/null 2>&1')
-                    if res != 0:
-                        # when PS not PDS, there's a .txt so we just redo?
-                        os.system(f'mv {repopath}/{nested_pdsfile}.txt {repopath}/{newnestpds} > /dev/null 2>&1')
-
-                    newxmi = repopath + "/" + member + ext
-                    # add nested XMI to root of repo
-                    os.system(f'cp /tmp/{pdsfile}/{member}{ext} {newxmi} > /dev/null 2>&1')
-                    # chop off all dem extensions :)
-                    for f in glob.glob(f'{repopath}/{newnestpds}/*'):
-                        path, file = os.path.split(f)
+        xmifile = info[0].filename
+        try:
+            # straight from the zip, parse it once, everything below works on this handle
+            xmidata = zip_ref.read(info[0])
+            lap('unzip', len(xmidata))
+            handle = XMIHandle(data=xmidata)
+            contents = handle.contents
+        except:
+            alerts.append(f"{datetime.datetime.now()} - ** ALERT CBT{cbtnum} **  {z} is zipped version of {xmifile} but that's no XMI??" + "\n")
+            result['unusable'] = 'no XMI'
+            return result
+        lap('parse', len(xmidata))
+
+        if contents == []:
+            # FILE062 has this too ...
+            alerts.append(f"{datetime.datetime.now()} - ** ALERT CBT{cbtnum} ** {z} unzipped to {xmifile} but that's not an XMI??" + "\n")
+            result['unusable'] = 'no XMI'
+            return result
+
+        pdsfile  = contents[0].split('(')[0]
+
+        new_repo = False
+        if not os.path.isdir(repopath):
+            os.mkdir(repopath)
+            new_repo = True
+        manifest = None if new_repo else load_manifest(repopath)
+        pathspecs = {}
+        outputs = {}    # path in repo -> manifest entry, everything this conversion writes
+        changed = set() # paths in repo that got (re)written or deleted
+
+        def wrote(path):
+            rel = os.path.relpath(path, repopath)
+            outputs[rel] = None
+            changed.add(rel)
+
+        def write_plain_member(member, dest, mimetype):
+            # a member that ends up as one file, skipped when its data is what we wrote last time
+            rel = os.path.relpath(dest, repopath)
+            entry = {'sha256': hashlib.sha256(handle.member_data(member)).hexdigest(), 'mimetype': mimetype}
+            outputs[rel] = entry
+            if manifest and manifest.get(rel) == entry and os.path.isfile(dest):
+                return
+            handle.write_member(member, dest)
+            changed.add(rel)
+
+        # No more extracting to /tmp, members get written straight to where they belong
+        ds = handle.dataset
+        if not ds or ds.pdstype != "PDS":
+            alerts.append(f"{datetime.datetime.now()} - ** ALERT CBT{cbtnum} ** No PDS in {xmifile}" + "\n")
+            result['unusable'] = 'No PDS'
+            return result
+        loglines.append(f'{datetime.datetime.now()} - Received {pdsfile} from {info[0].filename} ' + '\n')
+        # Create our target PDS-folder in repopath
+        mainpds = ds.dsnam.split('.')[-1]
+        pdsfolder = repopath + "/" + mainpds # last qualifier should do
+        os.makedirs(pdsfolder, exist_ok=True)
+        # add line to the .zigi/dsn file
+        dotzigidsn.append(f'{mainpds} PO FB 80 32720' + "\n")
+        # create placeholder for ISPFSTATS
+        dotzigispf[mainpds] = []
+        for member, member_info in ds.members.items():
+            # Loop all members in the received PDS from 'main' XMI
+            mimetype = member_info.mimetype
+            ext = member_info.ext
+            newmember = member.split('.')[0]
+            if mimetype.split('/')[0] == 'text':
+                # we just copy this over inside our repopath
+                write_plain_member(member, f'{pdsfolder}/{newmember}', mimetype)
+                # add the ISPFSTATS
+                if not member_info.ispf:
+                    member_info.ispf = {'version': '01.00', 'flags': 0, 'createdate': '1976-06-12T00:00:00.000000', 'modifydate': '1976-06-12T22:18:12.000000', 'lines': 0, 'newlines': 0, 'modlines': 0, 'user': 'CBT2GIT'}
+                dotzigispf[mainpds].append(ispfstatsfromxmi(member, member_info.ispf, alerts, cbtnum)+"\n")
+                loglines.append(f'{datetime.datetime.now()} - Found {member}{ext} ({mimetype}) in {pdsfile}, moved to {mainpds}/{member}' + '\n')
+            elif mimetype == 'application/xmit':
+                # we should assume this has no more nested xmi's and de-xmit it outside of the pds as a new pds
+                # dexmi, move
+                try:
+                    nested = XMIHandle(data=handle.member_data(member))
+                    nested_pdsfile  = nested.contents[0].split('(')[0] # last two qualifier should do all...
+                    nested.extract_all(repopath)
+                except:
+                     # for 982, the XMI is 'broken' ?
+                    alerts.append(f"{datetime.datetime.now()} - ** ALERT CBT{cbtnum} ** {pdsfile}/{member}{ext} no ispf data when de-xmi-ing" + "\n")
+                    continue
+                # skip all but last 2 qualifiers
+                newnestpds = '.'.join(nested_pdsfile.split('.')[-2:])
+                loglines.append(f'{datetime.datetime.now()} - Found {member}{ext} ({mimetype}) in {pdsfile}'+ '\n')
+                # move to correct spot
+                received = f'{repopath}/{nested_pdsfile}'
+                if not os.path.exists(received):
+                    # when PS not PDS, there's a .txt
+                    received += '.txt'
+                try:
+                    move(received, f'{repopath}/{newnestpds}')
+                    wrote(f'{repopath}/{newnestpds}')
+                except OSError as e:
+                    alerts.append(f"{datetime.datetime.now()} - ** ALERT CBT{cbtnum} ** {member}{ext} received as {nested_pdsfile} but could not move it to {newnestpds}: {e}" + "\n")
+
+                newxmi = repopath + "/" + member + ext
+                # add nested XMI to root of repo
+                handle.write_member(member, newxmi)
+                wrote(newxmi)
+                # chop off all dem extensions :) (list them all first, then rename)
+                nestfolder = f'{repopath}/{newnestpds}'
+                renames = []
+                if os.path.isdir(nestfolder):
+                    for file in os.listdir(nestfolder):
                         newfile = file.split('.')[0]  # breaks sortof if dots in membername..but that's impossible anyway :)
-                        noext = path + '/' + newfile
-                        # Deal with the dollars :)
-                        f = f.replace('$','\$')
-                        noext = noext.replace('$','\$')
-                        os.system(f'mv {f} {noext} > /dev/null 2>&1')
-
-                    # add ispfstats
-                    dotzigispf[newnestpds] = []
-                    nested_xmijson = json.loads(nested_xmi_obj.get_json())
-                    nested_xmi_file = list(nested_xmijson['file'].keys())[0]
-                    if not 'members' in nested_xmijson['file'][nested_xmi_file]:
-                        # TODO Phil: If no members, make the json have empty list for it?
-                        nested_xmijson['file'][nested_xmi_file]['members'] = []
-                    for nested_member in nested_xmijson['file'][nested_xmi_file]['members']:  
-                        nested_member_info = nested_xmijson['file'][nested_xmi_file]['members'][nested_member]
-                        dotzigispf[newnestpds].append(ispfstatsfromxmi(nested_member, nested_member_info['ispf'])+"\n")
-                        
-                    if 'COPYR1' in nested_xmijson:
-                        # FOR A PDS...
-                        print("NESTED PDS IN XMI XMI???? NEVER HAPPENS...")
-                        1/0
-                        for m in nested_xmijson['file'][nested_xmi_file]['members']:
-                            print(f"Calling ditzigispf for {m} {nested_xmijson['file'][nested_xmi_file]['members'][m]['ispf']}")
-                            dotzigispf[newnestpds].append(ispfstatsfromxmi(m, nested_xmijson['file'][nested_xmi_file]['members'][m]['ispf'])+"\n")
-                            loglines.append(f'{datetime.datetime.now()} - Found {m}{nested_xmijson["file"][nested_xmi_file]["members"][m]["extension"]} ({nested_xmijson["file"][nested_xmi_file]["members"][m]["mimetype"]}) in {member}{member_info["extension"]}, moved to {newnestpds}/{m}' + '\n')
-                        replace_pds(reponame, pdsfolder, member, ext, newmember, newnestpds)
-                        # add this member to the .zigi/<PDS> ispfstats, but change them...
+                        if newfile != file:
+                            renames.append((f'{nestfolder}/{file}', f'{nestfolder}/{newfile}'))
+                for f, noext in renames:
+                    try:
+                        os.replace(f, noext)
+                    except OSError as e:
+                        alerts.append(f"{datetime.datetime.now()} - ** ALERT CBT{cbtnum} ** could not rename {f} to {noext}: {e}" + "\n")
+
+                # add ispfstats
+                dotzigispf[newnestpds] = []
+                nested_members = nested.members()  # empty when there are no members
+                for nested_member, nested_member_info in nested_members.items():
+                    dotzigispf[newnestpds].append(ispfstatsfromxmi(nested_member, nested_member_info.ispf, alerts, cbtnum)+"\n")
+
+                if 'COPYR1' in nested.raw:
+                    # FOR A PDS...
+                    print("NESTED PDS IN XMI XMI???? NEVER HAPPENS...")
+                    1/0
+                    for m, m_info in nested_members.items():
+                        print(f"Calling ditzigispf for {m} {m_info.ispf}")
+                        dotzigispf[newnestpds].append(ispfstatsfromxmi(m, m_info.ispf, alerts, cbtnum)+"\n")
+                        loglines.append(f'{datetime.datetime.now()} - Found {m}{m_info.ext} ({m_info.mimetype}) in {member}{ext}, moved to {newnestpds}/{m}' + '\n')
+                    replace_pds(reponame, pdsfolder, member, ext, newmember, newnestpds)
+                    # add this member to the .zigi/<PDS> ispfstats, but change them...
+                    dd = datetime.datetime.now().strftime("%y/%m/%d")
+                    mm = datetime.datetime.now().strftime('%H:%M:%S')
+                    newispf = f"{member:<8} {dd} {dd} {1:>2} {0:>2} {mm} {7:>5} {7:>5} {0:>5} CBT2GIT"
+                    dotzigispf[mainpds].append(newispf + "\n")
+                    # add line to .zigi/dsn
+                    dotzigidsn.append(f'{newnestpds} PO FB 80 32720' + "\n")
+                else:
+                    # Figure out .zigi/dsn from xmi ifo?
+                    inmr02 = nested.inmr02(1)
+                    lrecl = inmr02['INMLRECL']
+                    dsorg = inmr02['INMDSORG']
+                    recfm = inmr02['INMRECFM']
+                    blksz = inmr02['INMBLKSZ']
+                    if recfm != "U":
+                        ok = f'{repopath}/{newnestpds}'
+                        loglines.append(f'{datetime.datetime.now()}   - Received to {reponame}/{newnestpds}' + '\n')
+                        wrote(f'{pdsfolder}/{newmember}')
+                        with open(f"{pdsfolder}/{newmember}",'w') as xmipds:
+                            xmipds.write(f"# +-------------------------------------------------------+" + "\n")
+                            xmipds.write(f"# |{'CBT2GIT DETECTED THIS WAS AN XMI FILE'.center(55)}" +  "|\n")
+                            xmipds.write(f"# |{'AND HAS RECEIVED IT TO'.center(55)}" + "|\n")
+                            newloc = reponame + "/" + newnestpds
+                            xmipds.write(f"# |{newloc.center(55)}" + "|\n")
+                            xmipds.write(f"# |{'THE ORIGINAL XMI HAS MOVED TO'.center(55)}" + "|\n")
+                            xmipds.write(f"# |{(reponame + '/' + member + ext).center(55)}" + "|\n")
+                            xmipds.write(f"# +-------------------------------------------------------+" + "\n")
                         dd = datetime.datetime.now().strftime("%y/%m/%d")
                         mm = datetime.datetime.now().strftime('%H:%M:%S')
                         newispf = f"{member:<8} {dd} {dd} {1:>2} {0:>2} {mm} {7:>5} {7:>5} {0:>5} CBT2GIT"
                         dotzigispf[mainpds].append(newispf + "\n")
-                        # add line to .zigi/dsn
-                        dotzigidsn.append(f'{newnestpds} PO FB 80 32720' + "\n")
+                        dotzigidsn.append(f'{ok.split("/")[-1]} {dsorg} {recfm} {lrecl} {blksz}' + "\n")
                     else:
-                        # Figure out .zigi/dsn from xmi ifo?
-                        lrecl = nested_xmijson['INMR02']['1']['INMLRECL']
-                        dsorg = nested_xmijson['INMR02']['1']['INMDSORG']
-                        recfm = nested_xmijson['INMR02']['1']['INMRECFM']
-                        blksz = nested_xmijson['INMR02']['1']['INMBLKSZ']
-                        if recfm != "U":
-                            ok = f'{repopath}/{newnestpds}'
-                            loglines.append(f'{datetime.datetime.now()}   - Received to {reponame}/{newnestpds}' + '\n')
-                            with open(f"{pdsfolder}/{newmember}",'w') as xmipds:
-                                xmipds.write(f"# +-------------------------------------------------------+" + "\n")
-                                xmipds.write(f"# |{'CBT2GIT DETECTED THIS WAS AN XMI FILE'.center(55)}" +  "|\n")
-                                xmipds.write(f"# |{'AND HAS RECEIVED IT TO'.center(55)}" + "|\n")
-                                newloc = reponame + "/" + newnestpds
-                                xmipds.write(f"# |{newloc.center(55)}" + "|\n") 
-                                xmipds.write(f"# |{'THE ORIGINAL XMI HAS MOVED TO'.center(55)}" + "|\n")
-                                xmipds.write(f"# |{(reponame + '/' + member + ext).center(55)}" + "|\n") 
-                                xmipds.write(f"# +-------------------------------------------------------+" + "\n")
-                            dd = datetime.datetime.now().strftime("%y/%m/%d")
-                            mm = datetime.datetime.now().strftime('%H:%M:%S')
-                            newispf = f"{member:<8} {dd} {dd} {1:>2} {0:>2} {mm} {7:>5} {7:>5} {0:>5} CBT2GIT"
-                            dotzigispf[mainpds].append(newispf + "\n")
-                            dotzigidsn.append(f'{ok.split("/")[-1]} {dsorg} {recfm} {lrecl} {blksz}' + "\n")
-                        else:
-                            # RECFM = U.... hmmm
-                            os.system(f"rm -rf {repopath}/{newnestpds}* > /dev/null 2>&1")  # dunno why I can't find where I copy it in the beginning, but it has to go
-                            os.system(f"cp '/tmp/{pdsfile}/{member}{ext}' '{repopath}/{member}{member_info['extension']}' > /dev/null 2>&1") # as replaced with the XMI file
-                            del dotzigispf[newnestpds] # no ispf stats, as it's  not a PDS :)
-                            os.system(f"rm {repopath}/.zigi/{newnestpds} > /dev/null 2>&1") # get rid of earlier generated ispfstats too
-                            with open(f"{pdsfolder}/{newmember}",'w') as xmipds:
-                                xmipds.write(f"# +-------------------------------------------------------+" + "\n")
-                                xmipds.write(f"# |{'CBT2GIT DETECTED THIS WAS AN XMI FILE'.center(55)}" +  "|\n")
-                                xmipds.write(f"# |{'IT CONTAINED RECFM=U DATA'.center(55)}" + "|\n")
-                                newloc = reponame + "/" + newnestpds
-                                xmipds.write(f"# |{'---'.center(55)}" + "|\n") 
-                                xmipds.write(f"# |{'THE ORIGINAL XMI HAS MOVED TO'.center(55)}" + "|\n")
-                                xmipds.write(f"# |{(reponame + '/' + member + ext).center(55)}" + "|\n") 
-                                xmipds.write(f"# +-------------------------------------------------------+" + "\n")
-                            loglines.append(f'{datetime.datetime.now()}   - Received RECFM=U data, stored XMIT file as {reponame}/{member}{ext}' + '\n')
-                            dd = datetime.datetime.now().strftime("%y/%m/%d")
-                            mm = datetime.datetime.now().strftime('%H:%M:%S')
-                            newispf = f"{member:<8} {dd} {dd} {1:>2} {0:>2} {mm} {7:>5} {7:>5} {0:>5} CBT2GIT"
-                            dotzigispf[mainpds].append(newispf + "\n")
-
-
-                    
-
-
-                elif mimetype in docmimetypes:
-                    # create the docs folder and move there
-                    target = f'{repopath}/docs'
-                    os.system(f'mkdir -p {target}')
-                    # extract xmi to target
-                    os.system(f"cp '/tmp/{pdsfile}/{member}{ext}' '{target}/{member}{ext}' > /dev/null 2>&1")
-                    loglines.append(f'{datetime.datetime.now()} - De-xmi-ed {member} to {reponame}/docs/{member}{ext}'+ '\n')
-                    with open(f"{pdsfolder}/{newmember}",'w') as xmipds:
-                                xmipds.write(f"# +-------------------------------------------------------+" + "\n")
-                                xmipds.write(f"# |{'CBT2GIT DETECTED THIS WAS AN XMI CONTAINING'.center(55)}" +  "|\n")
-                                xmipds.write(f"# |{'AN DOCUMENT MIME-TYPE'.center(55)}" + "|\n")
-                                xmipds.write(f"# |{mimetype.center(55)}" + "|\n") 
-                                xmipds.write(f"# |{'De-XMI-ed data STORED AS'.center(55)}" + "|\n")
-                                place = f'{reponame}/docs/{member}{ext}'
-                                xmipds.write(f"# |{place.center(55)}" + "|\n") 
-                                xmipds.write(f"# +-------------------------------------------------------+" + "\n")
-
-                elif mimetype == 'application/zip':
-                    target = f'{repopath}/{member}'
-                    canunzip = True
-                    loglines.append(f'{datetime.datetime.now()} - Found {member}{ext} ({mimetype}), trying to unzip'+ '\n')
-                    try:
-                        with zipfile.ZipFile(f'/tmp/{pdsfile}/{member}{ext}', 'r') as inner_zip:
-                            loglines.append(f'{datetime.datetime.now()} - Found {member}{ext} ({mimetype}), extracting to {reponame}/{member}'+ '\n')
-                        
-                            try:
-                                inner_zip.extractall(target)
-                            except Exception as e:
-                                # This happens in CBT432 : zipfile.BadZipFile: Bad CRC-32 for file 'VB40016.DLL'
-                                # This happens in BBT990 : zipfile.BadZipFile: File is not a zip file (for DEVTIPS@.zip)
-                                loglines.append(f'{datetime.datetime.now()}   - {e}'+ '\n')
-                    except Exception as e:
-                        loglines.append(f'{datetime.datetime.now()}   - {e}, kept as member'+ '\n')
-                        canunzip = False
-                 
-                    if canunzip:
+                        # RECFM = U.... hmmm
+                        for p in glob.glob(f'{repopath}/{glob.escape(newnestpds)}*'):  # dunno why I can't find where I copy it in the beginning, but it has to go
+                            remove(p)
+                        handle.write_member(member, f'{repopath}/{member}{ext}') # as replaced with the XMI file
+                        del dotzigispf[newnestpds] # no ispf stats, as it's  not a PDS :)
+                        remove(f'{repopath}/.zigi/{newnestpds}') # get rid of earlier generated ispfstats too
+                        wrote(f'{pdsfolder}/{newmember}')
                         with open(f"{pdsfolder}/{newmember}",'w') as xmipds:
+                            xmipds.write(f"# +-------------------------------------------------------+" + "\n")
+                            xmipds.write(f"# |{'CBT2GIT DETECTED THIS WAS AN XMI FILE'.center(55)}" +  "|\n")
+                            xmipds.write(f"# |{'IT CONTAINED RECFM=U DATA'.center(55)}" + "|\n")
+                            newloc = reponame + "/" + newnestpds
+                            xmipds.write(f"# |{'---'.center(55)}" + "|\n")
+                            xmipds.write(f"# |{'THE ORIGINAL XMI HAS MOVED TO'.center(55)}" + "|\n")
+                            xmipds.write(f"# |{(reponame + '/' + member + ext).center(55)}" + "|\n")
+                            xmipds.write(f"# +-------------------------------------------------------+" + "\n")
+                        loglines.append(f'{datetime.datetime.now()}   - Received RECFM=U data, stored XMIT file as {reponame}/{member}{ext}' + '\n')
+                        dd = datetime.datetime.now().strftime("%y/%m/%d")
+                        mm = datetime.datetime.now().strftime('%H:%M:%S')
+                        newispf = f"{member:<8} {dd} {dd} {1:>2} {0:>2} {mm} {7:>5} {7:>5} {0:>5} CBT2GIT"
+                        dotzigispf[mainpds].append(newispf + "\n")
+
+
+
+
+
+            elif mimetype in docmimetypes:
+                # create the docs folder and move there
+                target = f'{repopath}/docs'
+                os.makedirs(target, exist_ok=True)
+                # extract xmi to target
+                handle.write_member(member, f'{target}/{member}{ext}')
+                wrote(f'{target}/{member}{ext}')
+                loglines.append(f'{datetime.datetime.now()} - De-xmi-ed {member} to {reponame}/docs/{member}{ext}'+ '\n')
+                wrote(f'{pdsfolder}/{newmember}')
+                with open(f"{pdsfolder}/{newmember}",'w') as xmipds:
                             xmipds.write(f"# +-------------------------------------------------------+" + "\n")
                             xmipds.write(f"# |{'CBT2GIT DETECTED THIS WAS AN XMI CONTAINING'.center(55)}" +  "|\n")
                             xmipds.write(f"# |{'AN DOCUMENT MIME-TYPE'.center(55)}" + "|\n")
                             xmipds.write(f"# |{mimetype.center(55)}" + "|\n") 
-                            xmipds.write(f"# |{'RECEIVED AND UNZIPPED TO'.center(55)}" + "|\n")
-                            place = f'{reponame}/{member}'
+                            xmipds.write(f"# |{'De-XMI-ed data STORED AS'.center(55)}" + "|\n")
+                            place = f'{reponame}/docs/{member}{ext}'
                             xmipds.write(f"# |{place.center(55)}" + "|\n") 
                             xmipds.write(f"# +-------------------------------------------------------+" + "\n")
-                    else:
-                        # weird stuff (990) just keep da member
-                        os.system(f"cp '/tmp/{pdsfile}/{member}{ext}' '{pdsfolder}/{newmember}' > /dev/null 2>&1")
-
-                elif mimetype in ['application/java-archive', 'message/rfc822']:
-                    target = f'{repopath}/{member}'
-                    os.system(f'mkdir -p {target}')
-                    os.system(f"cp '/tmp/{pdsfile}/{member}{ext}' '{target}/{member}{ext}' > /dev/null 2>&1")
-                    loglines.append(f'{datetime.datetime.now()} - Found {member}{ext} ({mimetype}), moved to {reponame}/{member}{ext}'+ '\n')
+
+            elif mimetype == 'application/zip':
+                target = f'{repopath}/{member}'
+                canunzip = True
+                loglines.append(f'{datetime.datetime.now()} - Found {member}{ext} ({mimetype}), trying to unzip'+ '\n')
+                try:
+                    with zipfile.ZipFile(io.BytesIO(handle.member_data(member)), 'r') as inner_zip:
+                        loglines.append(f'{datetime.datetime.now()} - Found {member}{ext} ({mimetype}), extracting to {reponame}/{member}'+ '\n')
+
+                        try:
+                            wrote(target)
+                            inner_zip.extractall(target)
+                        except Exception as e:
+                            # This happens in CBT432 : zipfile.BadZipFile: Bad CRC-32 for file 'VB40016.DLL'
+                            # This happens in BBT990 : zipfile.BadZipFile: File is not a zip file (for DEVTIPS@.zip)
+                            loglines.append(f'{datetime.datetime.now()}   - {e}'+ '\n')
+                except Exception as e:
+                    loglines.append(f'{datetime.datetime.now()}   - {e}, kept as member'+ '\n')
+                    canunzip = False
+
+                if canunzip:
+                    wrote(f'{pdsfolder}/{newmember}')
                     with open(f"{pdsfolder}/{newmember}",'w') as xmipds:
                         xmipds.write(f"# +-------------------------------------------------------+" + "\n")
                         xmipds.write(f"# |{'CBT2GIT DETECTED THIS WAS AN XMI CONTAINING'.center(55)}" +  "|\n")
                         xmipds.write(f"# |{'AN DOCUMENT MIME-TYPE'.center(55)}" + "|\n")
                         xmipds.write(f"# |{mimetype.center(55)}" + "|\n") 
-                        xmipds.write(f"# |{'RECEIVED MOVED TO'.center(55)}" + "|\n")
-                        place = f'{reponame}/{member}{ext}'
+                        xmipds.write(f"# |{'RECEIVED AND UNZIPPED TO'.center(55)}" + "|\n")
+                        place = f'{reponame}/{member}'
                         xmipds.write(f"# |{place.center(55)}" + "|\n") 
                         xmipds.write(f"# +-------------------------------------------------------+" + "\n")
-
                 else:
-                    loglines.append(f'{datetime.datetime.now()} - Found {member}{ext} containing {mimetype}, moved to {mainpds}/{member}'+ '\n')
-                    res = os.system(f"cp '/tmp/{pdsfile}/{member}{ext}' '{pdsfolder}/{member}' > /dev/null 2>&1") # as replaced with the XMI file
-                    # loglines.append(f'{datetime.datetime.now()} - Found {member}{ext} containing {mimetype}, moved to {reponame}/{member}{ext}'+ '\n')
-                    # os.system(f"cp '/tmp/{pdsfile}/{member}{ext}' '{repopath}/{member}{ext}' > /dev/null 2>&1") # as replaced with the XMI file
-                    # with open(f"{pdsfolder}/{newmember}",'w') as xmipds:
-                    #             xmipds.write(f"# +-------------------------------------------------------+" + "\n")
-                    #             xmipds.write(f"# |{'CBT2GIT DETECTED THIS WAS AN XMI CONTAINING'.center(55)}" +  "|\n")
-                    #             xmipds.write(f"# |{'AN UNSUPPORTED MIME-TYPE'.center(55)}" + "|\n")
-                    #             xmipds.write(f"# |{mimetype.center(55)}" + "|\n") 
-                    #             xmipds.write(f"# |{'XMI data STORED AS'.center(55)}" + "|\n")
-                    #             place = f'{reponame}/{member}.xmi'
-                    #             xmipds.write(f"# |{place.center(55)}" + "|\n") 
-                    #             xmipds.write(f"# +-------------------------------------------------------+" + "\n")
-
-
-            # Also get the @FILEnnn into README
-            files  = glob.glob(repopath + f"/*{mainpds}/@FIL*")
-            # sanity check. There should be only one match
-            if len(files) != 1:
-                cccc = 'echo "No @FILE in PDS?"'
-                loglines.append(f'{datetime.datetime.now()} - No @FILExxx or @FILxxxx detected, creating README.md without extra info'+ '\n')
-            else:
-                cccc = f'cat {files[0]}'
-
-            # Now this is ugly as MD... so do some magix with it
-            nl = "\n"
-            os.system(f'echo "# {reponame}{nl}Converted to GitHub via [cbt2git](https://github.com/wizardofzos/cbt2git)" > {repopath}/README.md')
-            os.system(f'echo "This is still a work in progress. GitHub repos will be deleted and created during this period..." >> {repopath}/README.md')
-            os.system(f'echo "~~~~~~~~~~~~~~~~{nl}" >> {repopath}/README.md')
-            os.system(f'{cccc} >> {repopath}/README.md')
-            os.system(f'echo "~~~~~~~~~~~~~~~~{nl}" >> {repopath}/README.md')
-
-            # all parsed, write zigi files to repo (replaces existing...and that's what we want)
-            os.system(f'mkdir {repopath}/.zigi')
-            with open(f'{repopath}/.zigi/dsn', 'w') as dsnfile:
-                dsnfile.writelines(dotzigidsn)
-            for p in dotzigispf:
-                with open(f'{repopath}/.zigi/{p}', 'w') as ispffile:
-                    ispffile.writelines(dotzigispf[p])
-
-            # Do the thing with the pdf's docx et-al
-
-            # Append to logfile if we have one, otherwise create it
-            with open(f'{repopath}/cbt2git.log', 'a+') as dalog:
-                dalog.writelines(loglines)
-            
-            if new_repo:
-                # do_inital_add_commit_if_first :)
-                # cbt data via cbt.loc[cbt.cbtnum==cbtnum]['comment'].values[0]
-                os.system(f'cd {repopath} && git init --quiet')
-                os.system(f'cd {repopath} && git branch -M main --quiet')
-                attribfile(repopath)
-                msg = f"{z.split('/')[1].split('.')[0]} : Initial commit"
-                os.system(f'cd {repopath} && git add .')
-                os.system(f'cd {repopath} && git commit -m "{msg}" --quiet')
+                    # weird stuff (990) just keep da member
+                    write_plain_member(member, f'{pdsfolder}/{newmember}', mimetype)
+
+            elif mimetype in ['application/java-archive', 'message/rfc822']:
+                target = f'{repopath}/{member}'
+                os.makedirs(target, exist_ok=True)
+                handle.write_member(member, f'{target}/{member}{ext}')
+                wrote(f'{target}/{member}{ext}')
+                loglines.append(f'{datetime.datetime.now()} - Found {member}{ext} ({mimetype}), moved to {reponame}/{member}{ext}'+ '\n')
+                wrote(f'{pdsfolder}/{newmember}')
+                with open(f"{pdsfolder}/{newmember}",'w') as xmipds:
+                    xmipds.write(f"# +-------------------------------------------------------+" + "\n")
+                    xmipds.write(f"# |{'CBT2GIT DETECTED THIS WAS AN XMI CONTAINING'.center(55)}" +  "|\n")
+                    xmipds.write(f"# |{'AN DOCUMENT MIME-TYPE'.center(55)}" + "|\n")
+                    xmipds.write(f"# |{mimetype.center(55)}" + "|\n")
+                    xmipds.write(f"# |{'RECEIVED MOVED TO'.center(55)}" + "|\n")
+                    place = f'{reponame}/{member}{ext}'
+                    xmipds.write(f"# |{place.center(55)}" + "|\n")
+                    xmipds.write(f"# +-------------------------------------------------------+" + "\n")
+
             else:
-                # we're newer, so update the things..
-                os.system(f'cd {repopath} && git add . ')
-                os.system(f'cd {repopath} && git commit -m "Updates from cbttape.org ({datetime.datetime.now().strftime("%Y-%m-%d")})" --quiet')
-            
-            create_repo = False
-            
-            if not noremote:
-                try:
-                    repo = github.get_repo(f'{GITHUB_USER}/{reponame}')
-                except:
-                    create_repo = True
-                if create_repo:
-                    # create the repo at the github site, check for breakage...
-                    try:
-                        me.create_repo(
-                            reponame,
-                            private=False,
-                            description=cbt.loc[cbt.cbtnum==cbtnum]['comment'].values[0]
-                        )
-                    except:
-                        print("** SOMETHING BAD WHEN CREATING REPO (RATE LIMITS?)")
-                        logfile = f'cbt2git-log-{datetime.datetime.now().strftime("%Y-%j-%H-%M-%S")}'
-                        with open(logfile, 'w') as biglog:
-                            biglog.writelines(fulllog)
-                        # then sleep for long, so I get to keep this running unattended!
-                        time.sleep(600)
-                        continue
-
-                    # sleep a bit....... github seems to lag on creation?
-                    time.sleep(10) # just to be sure :)
-                    repourl = f'git@github.com:cbttape/{reponame}.git' 
-                    repourl = me.get_repo(reponame).ssh_url                   
-                    os.system(f'cd {repopath} && git remote add origin {repourl}')
-                    os.system(f'cd {repopath} && git push -u origin main --quiet')
-
-                # repo was there, we can justpush our updates
-                os.system(f'cd {repopath} && git push origin main --quiet')
-                rate_used, rate_init = github.rate_limiting
-                gracetime = (github.rate_limiting_resettime-math.floor(time.time())) / 1000
-                print(f"Rate critical? ({rate_used}/{rate_init}), gracetime={gracetime}")
-                if gracetime > 0:
-                    print(f'Sleep for twice the grace time...{gracetime*2} secs')
-                    time.sleep(gracetime*2)
-                
-                if i % 10 == 0 and only == 0:
-                    # every 10, and not if we running just one...
-                    # print("Sleep another 30secs every 10 repos...")
-                    print("sleep for 30...")
-                    time.sleep(30)
+                loglines.append(f'{datetime.datetime.now()} - Found {member}{ext} containing {mimetype}, moved to {mainpds}/{member}'+ '\n')
+                write_plain_member(member, f'{pdsfolder}/{member}', mimetype) # as replaced with the XMI file
+                # loglines.append(f'{datetime.datetime.now()} - Found {member}{ext} containing {mimetype}, moved to {reponame}/{member}{ext}'+ '\n')
+                # os.system(f"cp '/tmp/{pdsfile}/{member}{ext}' '{repopath}/{member}{ext}' > /dev/null 2>&1") # as replaced with the XMI file
+                # with open(f"{pdsfolder}/{newmember}",'w') as xmipds:
+                #             xmipds.write(f"# +-------------------------------------------------------+" + "\n")
+                #             xmipds.write(f"# |{'CBT2GIT DETECTED THIS WAS AN XMI CONTAINING'.center(55)}" +  "|\n")
+                #             xmipds.write(f"# |{'AN UNSUPPORTED MIME-TYPE'.center(55)}" + "|\n")
+                #             xmipds.write(f"# |{mimetype.center(55)}" + "|\n")
+                #             xmipds.write(f"# |{'XMI data STORED AS'.center(55)}" + "|\n")
+                #             place = f'{reponame}/{member}.xmi'
+                #             xmipds.write(f"# |{place.center(55)}" + "|\n")
+                #             xmipds.write(f"# +-------------------------------------------------------+" + "\n")
+
+
+        lap('members')
+
+        # Also get the @FILEnnn into README
+        files  = glob.glob(repopath + f"/*{mainpds}/@FIL*")
+        # sanity check. There should be only one match
+        if len(files) != 1:
+            atfile = b"No @FILE in PDS?\n"
+            loglines.append(f'{datetime.datetime.now()} - No @FILExxx or @FILxxxx detected, creating README.md without extra info'+ '\n')
+        else:
+            with open(files[0], 'rb') as f:
+                atfile = f.read()
+
+        # Now this is ugly as MD... so do some magix with it
+        nl = "\n"
+        readme = (f"# {reponame}{nl}Converted to GitHub via [cbt2git](https://github.com/wizardofzos/cbt2git){nl}"
+                  f"This is still a work in progress. GitHub repos will be deleted and created during this period...{nl}"
+                  f"~~~~~~~~~~~~~~~~{nl}{nl}").encode() + atfile + f"~~~~~~~~~~~~~~~~{nl}{nl}".encode()
+        outputs['README.md'] = None
+        if write_if_changed(f'{repopath}/README.md', readme):
+            changed.add('README.md')
+        lap('readme')
+
+        # all parsed, write zigi files to repo (replaces existing...and that's what we want)
+        os.makedirs(f'{repopath}/.zigi', exist_ok=True)
+        zigi = {'dsn': dotzigidsn}
+        zigi.update(dotzigispf)
+        for p, zigilines in zigi.items():
+            outputs[f'.zigi/{p}'] = None
+            if write_if_changed(f'{repopath}/.zigi/{p}', ''.join(zigilines)):
+                changed.add(f'.zigi/{p}')
+
+        # whatever the last conversion wrote that we didn't write this time has to go
+        if manifest is not None:
+            for rel in sorted(set(manifest) - set(outputs)):
+                remove(f'{repopath}/{rel}')
+                changed.add(rel)
+                loglines.append(f'{datetime.datetime.now()} - Removed {reponame}/{rel}, not on the tape anymore' + '\n')
+
+        # Do the thing with the pdf's docx et-al
+
+        # Append to logfile if we have one, otherwise create it
+        with open(f'{repopath}/cbt2git.log', 'a+') as dalog:
+            dalog.writelines(loglines)
+        changed.add('cbt2git.log')
+        lap('zigi')
+
+        if new_repo:
+            # do_inital_add_commit_if_first :)
+            # cbt data via cbt.loc[cbt.cbtnum==cbtnum]['comment'].values[0]
+            attribfile(repopath)
+            msg = f"{reponame} : Initial commit"
+            gitcmds = [['init', '--quiet'], ['branch', '-M', 'main', '--quiet'], ['add', '.'], ['commit', '-m', msg, '--quiet']]
+        elif manifest is None:
+            # converted before we kept manifests, let git find out what changed
+            msg = f'Updates from cbttape.org ({datetime.datetime.now().strftime("%Y-%m-%d")})'
+            gitcmds = [['add', '.'], ['commit', '-m', msg, '--quiet']]
+        else:
+            # we're newer, so update the things.. but only the things that changed
+            msg = f'Updates from cbttape.org ({datetime.datetime.now().strftime("%Y-%m-%d")})'
+            # paths go in on stdin, a big PDS has more members than fit on a command line
+            pathspecs = {'rm': '\0'.join(rel for rel in sorted(changed) if not os.path.lexists(f'{repopath}/{rel}')),
+                         'add': '\0'.join(rel for rel in sorted(changed) if os.path.lexists(f'{repopath}/{rel}'))}
+            gitcmds = [['rm', '-r', '--cached', '--quiet', '--ignore-unmatch', '--pathspec-from-file=-', '--pathspec-file-nul'],
+                       ['add', '--pathspec-from-file=-', '--pathspec-file-nul'],
+                       ['commit', '-m', msg, '--quiet']]
+            gitcmds = [cmd for cmd in gitcmds if cmd[0] not in pathspecs or pathspecs[cmd[0]]]
+        if fastimport:
+            # init (when new) and commit in one go, straight into the object database
+            errors = [fast_import_commit(repopath, msg, paths=None if manifest is None else sorted(changed))]
+        else:
+            errors = [git(repopath, *cmd, input=pathspecs.get(cmd[0])) for cmd in gitcmds]
+        for err in errors:
+            if err:
+                alerts.append(f"{datetime.datetime.now()} - ** ALERT CBT{cbtnum} ** {err}" + "\n")
+        # next time only what changed compared to this, unless git didn't get it all
+        if any(errors):
+            remove(f'{repopath}/{MANIFEST}')
+        else:
+            save_manifest(repopath, {rel: entry for rel, entry in outputs.items() if os.path.lexists(f'{repopath}/{rel}')})
+        lap('git')
+    result['converted'] = True
+    result['ok'] = not any(errors)
+    return result
+
+
+def description(cbtnum):
+    """Repo description, the comment from UPDATESTOC.txt. None for a tape that's not in the catalog
+    (gone from UPDATESTOC.txt, or --catalog isn't the one the downloader wrote)"""
+    comments = cbt.loc[cbt.cbtnum==cbtnum]['comment'].values
+    return comments[0] if len(comments) else None
+
+
+def crashed(z, e):
+    """Result for a tape that convert_tape() blew up on, so one bad tape doesn't stop the run"""
+    cbtnum = z.split('/CBT')[-1].split('.')[0]
+    reponame = os.path.basename(z).split('.')[0]
+    print(f"\n** Conversion of {z} failed: {e!r}")
+    return {'cbtnum': cbtnum, 'reponame': reponame, 'repopath': repos + "/" + reponame, 'converted': False, 'ok': False, 'unusable': None,
+            'loglines': [], 'alerts': [f"{datetime.datetime.now()} - ** ALERT CBT{cbtnum} ** Conversion of {z} failed: {e!r}" + "\n"]}
+
+
+def converted(i, z, result):
+    """Everything that happens in the main process once convert_tape() is done with a tape"""
+    pct = math.floor((i/len(toprocess))*100)
+    done = math.floor((pct/100)*40)
+    todo = 40 - done
+    done = done * "✅"
+    todo = todo * "🟩"
+    print(f'{done}{todo} {z} ({pct}%)', end='\r', flush=True)
+    fulllog.extend(result['alerts'])
+    if result['converted']:
+        try:
+            # what we just converted replaces whatever this tape had in the search index
+            if searchindex:
+                with tracer.stage(result['cbtnum'], 'index'):
+                    searchindex.replace_tape(int(result['cbtnum']), repo_members(result['repopath']))
+            if sync:
+                descr = description(result['cbtnum'])
+                if descr is None:
+                    fulllog.append(f"{datetime.datetime.now()} - ** ALERT CBT{result['cbtnum']} ** Not in the catalog, {result['reponame']} not published" + "\n")
+                    result['ok'] = False
+                else:
+                    # GitHub gets it when GitHub is ready for it, we go on with the next tape
+                    sync.publish(result['cbtnum'], result['reponame'], result['repopath'], descr)
+        except Exception as e:
+            print(f"\n** Indexing/publishing {result['reponame']} failed: {e!r}")
+            fulllog.append(f"{datetime.datetime.now()} - ** ALERT CBT{result['cbtnum']} ** Indexing/publishing {result['reponame']} failed: {e!r}" + "\n")
+            result['ok'] = False
+    if result['ok']:
+        # only now, a tape that failed (or didn't commit or publish) gets another go next run
+        processed[os.path.basename(z)] = toprocess_sha256[z]
+    elif result['unusable']:
+        # this zip won't ever convert, it gets another go when the zip changes
+        processed[os.path.basename(z)] = toprocess_sha256[z]
+        fulllog.append(f"{datetime.datetime.now()} - CBT{result['cbtnum']} can't be converted ({result['unusable']}), skipped until its zip changes" + "\n")
     # add log from this conersion to main full log
-    fulllog += loglines
-    # cleanup /tmp stuff
-    os.system(f'rm -rf /tmp/{pdsfile}')
-    os.system(f'rm -rf /tmp/{xmifile}')
+    fulllog.extend(result['loglines'])
+
+
+# creates, pushes and descriptions go through a queue that follows GitHub's rate limits (see cbtsync.py)
+sync = None if noremote else GitHubSync(github, me, tracer, pushers=args.pushers)
+
+if workers > 1:
+    # fork, so the workers get our parsed args and functions without re-running this script
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork')) as executor:
+        futures = {executor.submit(convert_tape, z): z for z in toprocess}
+        # the workers are forked on the first submit, only now it's safe to have a thread running
+        if sync:
+            sync.start()
+        for i, f in enumerate(as_completed(futures)):
+            try:
+                result = f.result()
+            except Exception as e:
+                result = crashed(futures[f], e)
+            converted(i, futures[f], result)
+else:
+    if sync:
+        sync.start()
+    for i,z in enumerate(toprocess):
+        try:
+            result = convert_tape(z)
+        except Exception as e:
+            result = crashed(z, e)
+        converted(i, z, result)
+
+# new descriptions from UPDATESTOC.txt
+if changes and sync:
+    for cbtnum in changes['comment_changed']:
+        descr = description(cbtnum)
+        if descr is not None:
+            sync.describe(cbtnum, f'CBT{cbtnum}', descr)
+
+if sync:
+    if sync.pending():
+        print(f"\nConversion done, waiting for GitHub to take the last {sync.pending()} jobs")
+    fulllog += sync.close()
+    print(f"GitHub: {sync.done} done, {sync.failed} failed ({len(sync.push_failures)} pushes), "
+          f"{sync.waited:.0f}s waited for rate limits")
 
 # sort on datetime (as we have extra messages in it from fulllog.append warnings that don't show in repo)
 fulllog = sorted(fulllog)
@@ -663,8 +893,26 @@ logfile = f'cbt2git-log-{datetime.datetime.now().strftime("%Y-%j-%H-%M-%S")}'
 with open(logfile, 'w') as biglog:
     biglog.writelines(fulllog)
 
+# remember what we processed, next run only picks up zips with another sha256
+with open(processedfile, 'w') as f:
+    json.dump(processed, f, indent=1, sort_keys=True)
+
+# the change set is handled, what's left in it is what failed (or --only skipped)
+if changes:
+    pending = {n for n in candidates
+               if not os.path.isfile(os.path.join(stage, f'CBT{n}.zip'))
+               or processed.get(f'CBT{n}.zip') != manifest.sha256(f'CBT{n}.zip')}
+    left = consume_changeset(changes, pending, described=sync is not None)
+    if left:
+        save_changeset(left, args.changes)
+        print(f"Change set {args.changes}: {len(changed_tapes(left))} tapes left for the next run")
+    elif os.path.exists(args.changes):
+        os.remove(args.changes)
+        print(f"Change set {args.changes} done and removed")
+
 # nice closing status-progress-bar-thunny
 done = 40 * "✅" 
 pct = 100
 z=''
 print(f'{done} {z} ({pct}%)', flush=True)
+tracer.close()
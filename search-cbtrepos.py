@@ -0,0 +1,57 @@
+#!/bin/env python
+"""Search the converted CBT members (the index process-local-cbtzips.py keeps up to date).
+
+Usage:
+    ./search-cbtrepos.py [-h] [--search SEARCH] [--only ONLY] [--limit LIMIT] text
+    options:
+    -h, --help       show this help message and exit
+    --search SEARCH  Search index. Defaults to ./.cbtsearch.sqlite
+    --only ONLY      Only search this CBT Tape
+    --limit LIMIT    Show at most this many lines. Defaults to 100
+
+Searching is case insensitive and looks for the text anywhere in a line, e.g.
+
+    ./search-cbtrepos.py "IEFBR14"
+    CBT100/FILE100/JCL1:2: //S1 EXEC PGM=IEFBR14
+
+Author:
+    Wizard of z/OS
+
+Version:
+    1.0 : Inital Version
+"""
+import argparse
+import time
+
+from cbtsearch import SearchIndex, SEARCHINDEX
+
+
+parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter, description="""Search the converted CBT members.
+Case insensitive, finds the text anywhere in a line""")
+
+parser.add_argument("text", type=str,
+                    help=f"What to look for")
+
+parser.add_argument("--search", type=str,
+                    default=SEARCHINDEX,
+                    help=f"""Search index. Defaults to ./{SEARCHINDEX}""")
+
+parser.add_argument("--only", type=int,
+                    default=0,
+                    help=f"""Only search this CBT Tape""")
+
+parser.add_argument("--limit", type=int,
+                    default=100,
+                    help=f"""Show at most this many lines. Defaults to 100""")
+
+args = parser.parse_args()
+
+start = time.time()
+index = SearchIndex(args.search)
+hits = index.search(args.text, tape=args.only or None, limit=args.limit)
+index.close()
+stop = time.time()
+
+for tape, pds, member, lineno, line in hits:
+    print(f"CBT{tape:003d}/{pds}/{member}:{lineno}: {line}")
+print(f"{len(hits)} lines{' (limit reached)' if len(hits) >= args.limit else ''} in {(stop-start)*1000:.0f} ms")